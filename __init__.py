@@ -11,74 +11,13 @@ bl_info = {
     "tracker_url":  "",
 }
 
-import bpy
-from bpy.props import *
-from bpy_extras.io_utils import ImportHelper
+try:
+    import bpy
+except ImportError:
+    bpy = None  # Running outside Blender (see garTool.py), only the file format modules are usable
 
-# ################################################################
-# Import/Export
-# ################################################################
-class ImportCmb(bpy.types.Operator, ImportHelper):
-    bl_idname = "import.cmb"
-    bl_label = "Import CMB"
-    
-    filename_ext = ".cmb"
-    filter_glob: bpy.props.StringProperty(default="*.cmb", options={'HIDDEN'})
-    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
-        
-    def execute( self, context ):
-        from .import_cmb import loadCmbFiles
-        return loadCmbFiles(self)
-        
-class ImportGar(bpy.types.Operator, ImportHelper):
-    bl_idname = "import.gar"
-    bl_label = "Import GAR"
-    
-    filename_ext = ".gar"
-    filter_glob: bpy.props.StringProperty(default="*.gar", options={'HIDDEN'})
-    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
-        
-    def execute( self, context ):
-        from .gar import loadGarFiles
-        return loadGarFiles(self)
-        
-class ImportGseb(bpy.types.Operator, ImportHelper):
-    bl_idname = "import.gseb"
-    bl_label = "Import GSEB"
-    
-    filename_ext = ".gseb"
-    filter_glob: bpy.props.StringProperty(default="*.gseb", options={'HIDDEN'})
-    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
-        
-    def execute( self, context ):
-        from .gseb import loadGsebFiles
-        return loadGsebFiles(self)
-    
-class ImportCtxb(bpy.types.Operator, ImportHelper):
-    bl_idname = "import.ctxb"
-    bl_label = "Import CTXB"
-    
-    filename_ext = ".ctxb"
-    filter_glob: bpy.props.StringProperty(default="*.ctxb", options={'HIDDEN'})
-    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
-    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
-        
-    def execute( self, context ):
-        from .ctxb import loadCtxbFiles
-        return loadCtxbFiles(self)
-
-# ################################################################
-# Common
-# ################################################################
-
-def menu_func_import( self, context ):
-    self.layout.operator( ImportCmb.bl_idname, text="CtrModelBinary (.cmb)")
-    self.layout.operator( ImportGar.bl_idname, text="GrezzoARchive (.gar)")
-    self.layout.operator( ImportGseb.bl_idname, text="GrezzoSceneBinary (.gseb)")
-    self.layout.operator( ImportCtxb.bl_idname, text="CtrTeXtureBinary (.ctxb)")
+if bpy is not None:
+    from .operators import *
 
 def register():
     print("Registering CMB\n")
@@ -86,7 +25,12 @@ def register():
     bpy.utils.register_class(ImportGar)
     bpy.utils.register_class(ImportGseb)
     bpy.utils.register_class(ImportCtxb)
+    bpy.utils.register_class(ReplaceCmbProxies)
     bpy.types.TOPBAR_MT_file_import.append(menu_func_import)
+    bpy.types.VIEW3D_MT_object.append(menu_func_object)
+
+    from .materials import clearMaterialQueue
+    bpy.app.handlers.load_pre.append(clearMaterialQueue)
 
 def unregister():
     print("Unregistering CMB\n")
@@ -94,7 +38,15 @@ def unregister():
     bpy.utils.unregister_class(ImportGar)
     bpy.utils.unregister_class(ImportGseb)
     bpy.utils.unregister_class(ImportCtxb)
+    bpy.utils.unregister_class(ReplaceCmbProxies)
     bpy.types.TOPBAR_MT_file_import.remove(menu_func_import)
+    bpy.types.VIEW3D_MT_object.remove(menu_func_object)
+
+    from .materials import clearMaterialQueue, buildQueuedMaterialsTick
+    bpy.app.handlers.load_pre.remove(clearMaterialQueue)
+    clearMaterialQueue()
+    if bpy.app.timers.is_registered(buildQueuedMaterialsTick):
+        bpy.app.timers.unregister(buildQueuedMaterialsTick)
     
 if __name__ == "__main__":
     register()
\ No newline at end of file
@@ -0,0 +1,216 @@
+import os, sys, json, time, types, argparse, subprocess, importlib
+
+# Converts CMB/GAR/ZAR/GSEB files to one .blend each, using several background Blender processes:
+#   blender -b -P io_scene_cmb/batch.py -- romfs/model -o out --jobs 4
+# Progress is kept in a queue file in the output folder, so running the same command again after
+# a crash (or Ctrl+C) carries on with the files that haven't been converted yet.
+
+InputExts = ("cmb", "gar", "zar", "gseb")
+QueueFileName = "batch_queue.json"
+ReportFileName = "batch_report.json"
+
+# Options for the import operators that the batch runner doesn't expose
+WorkerOptions = {
+    "defer_materials": False,  # Timers never get to run before the file is saved
+    "instance_models": True,
+    "prefetch_models": True,
+    "rooms": "",
+    "use_region": False,
+    "region_min": (0.0, 0.0, 0.0),
+    "region_max": (0.0, 0.0, 0.0),
+}
+
+def findInputs(paths: list[str]):
+    # Yields (input path, output path relative to the output folder). The input's extension is
+    # kept (foo.gar.blend), as a model often has a .cmb and a .gar of the same name.
+    for path in paths:
+        if not os.path.isdir(path):
+            yield os.path.abspath(path), os.path.basename(path) + ".blend"
+            continue
+
+        for dirpath, _, fileNames in os.walk(path):
+            for fileName in sorted(fileNames):
+                if os.path.splitext(fileName)[1].lstrip(".").lower() in InputExts:
+                    inputPath = os.path.join(dirpath, fileName)
+                    yield os.path.abspath(inputPath), os.path.relpath(inputPath, path) + ".blend"
+
+def findCollisions(queue: "JobQueue") -> dict[str, list[str]]:
+    # Output paths that more than one input would be saved to, e.g. files of the same name
+    # passed from different folders
+    inputsByOutput = {}
+    for inputPath, job in queue.jobs.items():
+        inputsByOutput.setdefault(os.path.normcase(job["output"]), []).append(inputPath)
+    return {output: inputPaths for output, inputPaths in inputsByOutput.items() if len(inputPaths) > 1}
+
+def buildCatalogs(inputPaths: list[str]):
+    # Builds or refreshes the catalog of each RomFS dump once, before the workers start, so they
+    # only have to load it rather than each walking the dump
+    from .catalog import RomFSCatalog, findRomFSRoot
+    for root in sorted({findRomFSRoot(inputPath) for inputPath in inputPaths} - {None}):
+        print(f"Cataloguing {root}")
+        RomFSCatalog.load(root)
+
+class JobQueue(object):
+    # Per-file status, saved after every change: pending, running, done or failed
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.jobs = json.load(f)["jobs"]
+
+        # Jobs that were running when the last run stopped are started again
+        for job in self.jobs.values():
+            if job["status"] == "running":
+                job["status"] = "pending"
+
+    def add(self, inputPath: str, outputPath: str, retryFailed: bool):
+        job = self.jobs.setdefault(inputPath, {"output": outputPath, "status": "pending", "attempts": 0})
+        if retryFailed and job["status"] == "failed":
+            job["status"] = "pending"
+
+    def pending(self) -> list[str]:
+        return [inputPath for inputPath, job in self.jobs.items() if job["status"] == "pending"]
+
+    def update(self, inputPath: str, **values):
+        self.jobs[inputPath].update(values)
+        self.save()
+
+    def save(self):
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump({"jobs": self.jobs}, f, indent=1)
+        os.replace(f"{self.path}.tmp", self.path)
+
+def runBatch(args, blender: str) -> int:
+    os.makedirs(args.output, exist_ok=True)
+    queue = JobQueue(os.path.join(args.output, QueueFileName))
+    for inputPath, outputPath in findInputs(args.paths):
+        queue.add(inputPath, os.path.join(os.path.abspath(args.output), outputPath), args.retry_failed)
+
+    collisions = findCollisions(queue)
+    if collisions:
+        for output, inputPaths in collisions.items():
+            print(f"Failed to start: {len(inputPaths)} files would be saved to {output}: {', '.join(inputPaths)}")
+        return 2
+    queue.save()
+
+    options = json.dumps({"use_custom_normals": not args.no_custom_normals, "proxy_mode": args.proxy_mode, "profile_import": args.profile,
+                          # The workers share the CPUs, rather than each prefetching with one thread and process per CPU
+                          "prefetch_workers": max(1, (os.cpu_count() or 1) // args.jobs)})
+    pending = queue.pending()
+    running = {}
+    converted = []
+    started = time.perf_counter()
+    print(f"{len(pending)} of {len(queue.jobs)} files to convert")
+    buildCatalogs(pending)
+
+    while pending or running:
+        while pending and len(running) < args.jobs:
+            inputPath = pending.pop(0)
+            job = queue.jobs[inputPath]
+            os.makedirs(os.path.dirname(job["output"]), exist_ok=True)
+            command = [blender, "-b", "--factory-startup", "-P", os.path.abspath(__file__), "--",
+                       "--worker", inputPath, job["output"], "--options", options]
+            # Output goes to a log next to the .blend rather than a pipe, which a chatty worker could fill
+            with open(f"{job['output']}.log", "w") as log:
+                process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+            running[inputPath] = (process, time.perf_counter())
+            queue.update(inputPath, status="running", attempts=job["attempts"] + 1)
+
+        time.sleep(0.1)
+        for inputPath, (process, jobStarted) in list(running.items()):
+            if process.poll() is None:
+                if args.timeout > 0 and time.perf_counter() - jobStarted > args.timeout:
+                    process.kill()
+                continue
+
+            del running[inputPath]
+            seconds = round(time.perf_counter() - jobStarted, 3)
+            outputPath = queue.jobs[inputPath]["output"]
+            if process.returncode == 0 and os.path.exists(outputPath):
+                os.remove(f"{outputPath}.log")
+                converted.append(inputPath)
+                queue.update(inputPath, status="done", seconds=seconds, error=None)
+            else:
+                with open(f"{outputPath}.log", "r", errors="replace") as log:
+                    error = log.read()[-2000:]
+                queue.update(inputPath, status="failed", seconds=seconds, error=error or f"Exit code {process.returncode}")
+            print(f"{queue.jobs[inputPath]['status']}: {inputPath} ({seconds}s)")
+
+    writeReport(queue, converted, os.path.join(args.output, ReportFileName), time.perf_counter() - started)
+    return 0 if all(job["status"] == "done" for job in queue.jobs.values()) else 1
+
+def writeReport(queue: JobQueue, converted: list[str], path: str, seconds: float):
+    # Throughput is for the files converted by this run, not ones finished before a resume
+    inputBytes = sum(os.path.getsize(inputPath) for inputPath in converted if os.path.exists(inputPath))
+    report = {
+        "files": len(queue.jobs),
+        "done": sum(1 for job in queue.jobs.values() if job["status"] == "done"),
+        "converted": len(converted),
+        "failed": sum(1 for job in queue.jobs.values() if job["status"] == "failed"),
+        "pending": sum(1 for job in queue.jobs.values() if job["status"] == "pending"),
+        "seconds": round(seconds, 3),
+        "filesPerMinute": round(len(converted) / seconds * 60, 2) if seconds > 0 else 0,
+        "inputBytes": inputBytes,
+        "inputMiBPerSecond": round(inputBytes / (1 << 20) / seconds, 3) if seconds > 0 else 0,
+        "jobs": queue.jobs,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=1)
+    print(f"{report['done']} done, {report['failed']} failed in {report['seconds']}s ({report['filesPerMinute']} files/min), see {path}")
+
+def convertFile(inputPath: str, outputPath: str, options: dict):
+    # Runs inside a worker Blender: imports one file into an empty scene and saves it
+    import bpy
+    from .import_cmb import loadCmbFiles
+    from .import_gar import loadGarFiles
+    from .gseb import loadGsebFiles
+
+    bpy.ops.wm.read_factory_settings(use_empty=True)
+    operator = types.SimpleNamespace(filepath=inputPath, directory=os.path.dirname(inputPath),
+                                     files=[types.SimpleNamespace(name=os.path.basename(inputPath))],
+                                     profile_json=f"{outputPath}.profile.json" if options.get("profile_import") else "",
+                                     **{**WorkerOptions, **options})
+    match os.path.splitext(inputPath)[1].lstrip(".").lower():
+        case "cmb":
+            loadCmbFiles(operator)
+        case "gar" | "zar":
+            loadGarFiles(operator)
+        case "gseb":
+            loadGsebFiles(operator)
+    bpy.ops.wm.save_as_mainfile(filepath=outputPath)
+
+def main(argv: list[str]):
+    parser = argparse.ArgumentParser(prog="batch", description="Convert CMB/GAR/ZAR/GSEB files to .blend files in the background")
+    parser.add_argument("paths", nargs="*", help="Files, or folders to search for files")
+    parser.add_argument("-o", "--output", default="converted", help="Folder for the .blend files, the queue and the report")
+    parser.add_argument("-j", "--jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Number of Blender processes")
+    parser.add_argument("--timeout", type=float, default=0, help="Seconds before a file is given up on (0 for no limit)")
+    parser.add_argument("--retry-failed", action="store_true", help="Try files that failed in an earlier run again")
+    parser.add_argument("--no-custom-normals", action="store_true", help="Don't set custom split normals")
+    parser.add_argument("--profile", action="store_true", help="Write the time spent in each import stage next to each .blend")
+    parser.add_argument("--proxy-mode", choices=["NONE", "BOUNDS", "DECIMATED"], default="NONE", help="Import proxies instead of full models")
+    parser.add_argument("--worker", nargs=2, metavar=("INPUT", "OUTPUT"), help=argparse.SUPPRESS)
+    parser.add_argument("--options", default="{}", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        convertFile(args.worker[0], args.worker[1], json.loads(args.options))
+        return 0
+
+    import bpy
+    return runBatch(args, bpy.app.binary_path)
+
+if __name__ == "__main__":
+    # Blender runs this file as a script, so the add-on is imported as a package to use its modules
+    addonFolder = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.dirname(addonFolder))
+    batch = importlib.import_module(f"{os.path.basename(addonFolder)}.batch")
+    argv = sys.argv[sys.argv.index("--") + 1:] if "--" in sys.argv else []
+    try:
+        exitCode = batch.main(argv)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        exitCode = 1
+    sys.exit(exitCode)
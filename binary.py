@@ -0,0 +1,120 @@
+import struct, hashlib, mmap, io
+
+from io import BufferedReader
+from .cmbEnums import DataTypes
+
+def getFlag(value, index, increment):
+    index += increment
+    return ((value >> index) & 1) != 0
+
+def align(file: BufferedReader, size=4):
+    while (file.tell() % size):
+        file.seek(file.tell() + 1)
+
+def readUByte(file: BufferedReader) -> int:
+    return struct.unpack("B", file.read(1))[0]
+
+def readByte(file: BufferedReader) -> int:
+    return struct.unpack("b", file.read(1))[0]
+
+def readBytes(file: BufferedReader, count) -> list[int]:
+    return [readUByte(file) for _ in range(count)]
+
+def readUShort(file: BufferedReader) -> int:
+    return struct.unpack("<H", file.read(2))[0]
+
+def readShort(file: BufferedReader) -> int:
+    return struct.unpack("<h", file.read(2))[0]
+
+def readUInt32(file: BufferedReader) -> int:
+    return struct.unpack("<I", file.read(4))[0]
+
+def readInt32(file: BufferedReader) -> int:
+    return struct.unpack("<i", file.read(4))[0]
+
+def readFloat(file: BufferedReader) -> float:
+    return struct.unpack("<f", file.read(4))[0]
+
+def readArray(file: BufferedReader, elements, datatype: DataTypes = DataTypes.Float) -> list:
+    return [readDataType(file, datatype) for _ in range(elements)]
+
+def readDataType(file: BufferedReader, dt: DataTypes):
+    match dt:
+        case DataTypes.Byte:
+            return readByte(file)
+        case DataTypes.UByte:
+            return readUByte(file)
+        case DataTypes.Short:
+            return readShort(file)
+        case DataTypes.UShort:
+            return readUShort(file)
+        case DataTypes.Int:
+            return readInt32(file)
+        case DataTypes.UInt:
+            return readUInt32(file)
+        case _:
+            return readFloat(file)
+
+def getDataTypeSize(dt) -> int:
+    match dt:
+        case DataTypes.Byte | DataTypes.UByte:
+            return 1
+        case DataTypes.Short | DataTypes.UShort:
+            return 2
+        case _:
+            return 4
+
+def readString(file: BufferedReader, length=0) -> str:
+    if (length > 0):
+        return bytes(file.read(length)).decode("ASCII").replace("\x00", '')
+    else:
+        return ''.join(iter(lambda: bytes(file.read(1)).decode("ASCII"), '\x00' or ''))
+
+class MemoryReader:
+    # File-like reader over a bytes-like buffer. Reads return memoryview slices of the
+    # buffer rather than copies, so nested files can be parsed in place.
+    def __init__(self, buffer):
+        self.view = memoryview(buffer)
+        self.position = 0
+
+    def read(self, size: int = -1) -> memoryview:
+        end = len(self.view) if size < 0 else min(self.position + size, len(self.view))
+        data = self.view[self.position:end]
+        self.position = end
+        return data
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        match whence:
+            case io.SEEK_CUR:
+                offset += self.position
+            case io.SEEK_END:
+                offset += len(self.view)
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+def openMapped(path: str) -> MemoryReader:
+    # The mapping outlives the file handle, and is released once nothing references it
+    with open(path, "rb") as file:
+        try:
+            return MemoryReader(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+        except ValueError:
+            return MemoryReader(file.read())  # Empty files can't be mapped
+
+def getContentHash(file: BufferedReader) -> str:
+    # Hashes the whole file and leaves it rewound for parsing
+    file.seek(0)
+    digest = hashlib.sha1()
+    for chunk in iter(lambda: file.read(1 << 20), b''):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+def readOffsetString(file: BufferedReader, offset: int, length: int = 0) -> str:
+    temp = file.tell()
+    file.seek(offset)
+    value = readString(file, length)
+    file.seek(temp)
+    return value
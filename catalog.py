@@ -0,0 +1,188 @@
+import os, sys, json, hashlib
+
+from .binary import MemoryReader, openMapped
+from .gar import GAR
+
+# Index of every model and texture in a RomFS dump, saved next to it (or in the user's cache
+# folder if the dump is read-only) so later imports can resolve names without searching the
+# folders. Only folders whose mtime changed since the last import are listed again, and in them
+# only files whose mtime or size changed are read again. A file rewritten in place doesn't touch
+# its folder's mtime, so delete the catalog to pick that up.
+
+CatalogFileName = ".cmb_catalog.json"
+CatalogVersion = 2
+ModelExts = ("cmb", "zar", "gar")  # In the order loadGseb prefers them
+IndexedExts = ModelExts + ("ctxb",)
+ArchiveExts = ("zar", "gar")
+
+class RomFSCatalog(object):
+    def __init__(self, root: str):
+        self.root = root
+        # Relative path -> {"mtime", "size", "entries": [[name, ext, offset, size], ...] for archives}
+        self.files = {}
+        # Relative folder path ("" for the root) -> {"mtime", "folders": [subfolder names], "files": [indexed file names]}
+        self.folders = {}
+        # Relative path without extension -> extension of the loose model file
+        self.models = {}
+        # "name.ext" -> [(relative file path, offset, size), ...], loose files and archive entries alike
+        self.entries = {}
+        self.mapped = {}
+
+    @staticmethod
+    def load(root: str) -> "RomFSCatalog":
+        catalog = RomFSCatalog(root)
+        for path in (os.path.join(root, CatalogFileName), getCachePath(root)):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == CatalogVersion:
+                    catalog.files = data["files"]
+                    catalog.folders = data["folders"]
+                    break
+            except (OSError, ValueError, KeyError):
+                pass  # Missing or unreadable, so it's rebuilt from scratch
+
+        if catalog.refresh():
+            catalog.save()
+        return catalog
+
+    def save(self):
+        for path in (os.path.join(self.root, CatalogFileName), getCachePath(self.root)):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Per process, as batch workers importing from the same dump can save at the same time
+                tempPath = f"{path}.{os.getpid()}.tmp"
+                with open(tempPath, "w") as f:
+                    json.dump({"version": CatalogVersion, "files": self.files, "folders": self.folders}, f)
+                os.replace(tempPath, path)
+                return
+            except OSError as ex:
+                error = ex  # Read-only dump, so it goes to the cache folder instead
+        print(f"Warning: Couldn't save the RomFS catalog: {error}")
+
+    def refresh(self) -> bool:
+        # Returns whether anything changed since the catalog was saved
+        files = {}
+        folders = {}
+        changed = False
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            path = os.path.join(self.root, *folder.split("/"))
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue  # Removed since it was listed, which its parent's listing already noticed
+
+            previous = self.folders.get(folder)
+            if previous is not None and previous["mtime"] == mtime:
+                # Nothing was added, removed or renamed in it, so its files are kept without a stat each
+                folders[folder] = previous
+                prefix = f"{folder}/" if folder else ""
+                for fileName in previous["files"]:
+                    files[prefix + fileName] = self.files[prefix + fileName]
+                pending.extend(prefix + name for name in previous["folders"])
+                continue
+
+            info = folders[folder] = {"mtime": mtime, "folders": [], "files": []}
+            for entry in sorted(os.scandir(path), key=lambda entry: entry.name):
+                relativePath = f"{folder}/{entry.name}" if folder else entry.name
+                if entry.is_dir():
+                    info["folders"].append(entry.name)
+                    pending.append(relativePath)
+                    continue
+                if os.path.splitext(entry.name)[1].lstrip(".") not in IndexedExts:
+                    continue
+
+                info["files"].append(entry.name)
+                stat = entry.stat()
+                previousFile = self.files.get(relativePath)
+                if previousFile is not None and previousFile["mtime"] == stat.st_mtime and previousFile["size"] == stat.st_size:
+                    files[relativePath] = previousFile
+                else:
+                    files[relativePath] = self.readFile(entry.path, stat)
+                    changed = True
+
+            # Saving the catalog itself touches the root's mtime, which on its own isn't worth saving again
+            if previous is None or previous["folders"] != info["folders"] or previous["files"] != info["files"]:
+                changed = True
+
+        self.files = files
+        self.folders = folders
+        self.buildIndex()
+        return changed
+
+    def readFile(self, path: str, stat: os.stat_result) -> dict:
+        info = {"mtime": stat.st_mtime, "size": stat.st_size}
+        if os.path.splitext(path)[1].lstrip(".") in ArchiveExts:
+            info["entries"] = []
+            try:
+                indexArchive(GAR(openMapped(path)), 0, info["entries"])
+            except Exception as ex:
+                print(f"Warning: Couldn't read archive '{path}': {ex}")
+        return info
+
+    def buildIndex(self):
+        self.models = {}
+        self.entries = {}
+        for relativePath, info in self.files.items():
+            stem, ext = os.path.splitext(relativePath)
+            ext = ext.lstrip(".")
+            if ext in ModelExts:
+                current = self.models.get(stem)
+                if current is None or ModelExts.index(ext) < ModelExts.index(current):
+                    self.models[stem] = ext
+            self.entries.setdefault(os.path.basename(relativePath), []).append((relativePath, 0, info["size"]))
+            for name, entryExt, offset, size in info.get("entries", []):
+                self.entries.setdefault(f"{name}.{entryExt}", []).append((relativePath, offset, size))
+
+    def findModel(self, path: str) -> str:
+        # Takes a path without extension, as loadGseb builds them, and returns it with one
+        stem = os.path.relpath(path, self.root).replace(os.sep, "/")
+        ext = self.models.get(stem)
+        return f"{path}.{ext}" if ext is not None else None
+
+    def findEntry(self, name: str, ext: str) -> tuple:
+        locations = self.entries.get(f"{name}.{ext}")
+        return locations[0] if locations else None
+
+    def openEntry(self, location: tuple) -> MemoryReader:
+        relativePath, offset, size = location
+        if relativePath not in self.mapped:
+            self.mapped[relativePath] = openMapped(os.path.join(self.root, *relativePath.split("/")))
+        return MemoryReader(self.mapped[relativePath].view[offset:offset + size])
+
+def indexArchive(gar: GAR, baseOffset: int, entries: list):
+    # Offsets are from the start of the file on disk, including for entries of nested archives
+    for entry in gar:
+        if entry.Ext in ArchiveExts:
+            indexArchive(GAR(entry.open()), baseOffset + entry.Offset, entries)
+        elif entry.Ext in IndexedExts:
+            entries.append([entry.FileName, entry.Ext, baseOffset + entry.Offset, entry.Size])
+
+def getCachePath(root: str) -> str:
+    # Where the catalog of a read-only dump is kept, one file per dump folder
+    if sys.platform == "win32":
+        cacheFolder = os.environ.get("LOCALAPPDATA") or os.path.expanduser("~")
+    else:
+        cacheFolder = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    name = hashlib.sha1(os.path.abspath(root).encode()).hexdigest()[:16]
+    return os.path.join(cacheFolder, "io_scene_cmb", f"catalog_{name}.json")
+
+def findRomFSRoot(path: str) -> str:
+    # The nearest folder above the path that has the RomFS model folders in it
+    folder = os.path.dirname(os.path.abspath(path))
+    while True:
+        if os.path.isdir(os.path.join(folder, "model")) or os.path.isdir(os.path.join(folder, "mapmdl")):
+            return folder
+        parent = os.path.dirname(folder)
+        if parent == folder:
+            return None
+        folder = parent
+
+def getCatalog(session, root: str) -> RomFSCatalog:
+    if root is None:
+        return None
+    if session.catalog is None or session.catalog.root != root:
+        session.catalog = RomFSCatalog.load(root)
+    return session.catalog
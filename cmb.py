@@ -1,6 +1,6 @@
 import sys, os
 from io import BufferedReader
-from .utils import (align, readDataType, readString, readArray, readFloat, 
+from .binary import (align, readDataType, readString, readArray, readFloat, 
                     readUInt32, readInt32, readUShort, 
                     readShort, readByte, readUByte)
 from .cmbEnums import *
@@ -11,6 +11,7 @@ class Cmb(object):
     def __init__(self):
         self.version = Version
         self.name = "Dummy CMB"
+        self.fileSize = 0
         self.texDataOfs = 0
         self.indicesOfs = 0
         self.vatrOfs = 0
@@ -49,6 +50,7 @@ class Cmb(object):
         self.indicesOfs = header.faceIndicesOfs
         self.vatrOfs = header.vatrOfs
         self.name = header.name
+        self.fileSize = header.filesize
         self.version = Version
 
         return self
@@ -0,0 +1,137 @@
+import numpy as np
+
+from .cmb import Material, Combiner
+from .cmbEnums import TexCombineMode, TexCombinerSource, TexCombinerColorOp
+
+# Evaluates a material's combiner stages on the CPU, following the same maths as the
+# node graph built by materials.generateMaterial. Colours are (H, W, 3) arrays and
+# alphas are (H, W, 1) arrays, so NumPy broadcasting matches the math node behaviour.
+
+LuminanceWeights = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)  # Rec.709, as Blender converts colour to float
+
+def getConstant(rgba: list) -> tuple:
+    colour = np.asarray(rgba, dtype=np.float32)
+    return (colour[:3].reshape(1, 1, 3), colour[3:4].reshape(1, 1, 1))
+
+def getOperand(source: tuple, operand: TexCombinerColorOp) -> np.ndarray:
+    colour, alpha = source
+    match operand:
+        case TexCombinerColorOp.Color:
+            return colour
+        case TexCombinerColorOp.Alpha:
+            return alpha
+        case TexCombinerColorOp.Red:
+            return colour[..., 0:1]
+        case TexCombinerColorOp.Green:
+            return colour[..., 1:2]
+        case TexCombinerColorOp.Blue:
+            return colour[..., 2:3]
+        case TexCombinerColorOp.OneMinusColor:
+            return 1.0 - colour
+        case TexCombinerColorOp.OneMinusAlpha:
+            return 1.0 - alpha
+        case TexCombinerColorOp.OneMinusRed:
+            return 1.0 - colour[..., 0:1]
+        case TexCombinerColorOp.OneMinusGreen:
+            return 1.0 - colour[..., 1:2]
+        case TexCombinerColorOp.OneMinusBlue:
+            return 1.0 - colour[..., 2:3]
+
+def getModeOutput(combinerMode: TexCombineMode, values: list) -> np.ndarray:
+    match combinerMode:
+        case TexCombineMode.Replace:
+            return values[0]
+        case TexCombineMode.Modulate:
+            return values[0] * values[1]
+        case TexCombineMode.Add | TexCombineMode.AddSigned:
+            return values[0] + values[1]
+        case TexCombineMode.Subtract:
+            return values[0] - values[1]
+        case TexCombineMode.MultAdd:
+            return values[0] * values[1] + values[2]
+        case TexCombineMode.AddMult:
+            return (values[0] + values[1]) * values[2]
+        case TexCombineMode.Interpolate:
+            # Per channel, as the hardware does it (a colour factor broadcasts across the channels)
+            fac = np.clip(values[2], 0.0, 1.0)
+            return values[1] * (1.0 - fac) + values[0] * fac
+        case TexCombineMode.DotProduct3Rgb | TexCombineMode.DotProduct3Rgba:
+            a, b = np.broadcast_arrays(values[0], values[1])
+            return np.sum(a * b, axis=-1, keepdims=True)
+
+def getSourceCount(combinerMode: TexCombineMode) -> int:
+    match combinerMode:
+        case TexCombineMode.Replace:
+            return 1
+        case TexCombineMode.Interpolate | TexCombineMode.MultAdd | TexCombineMode.AddMult:
+            return 3
+        case _:
+            return 2
+
+def resample(pixels: np.ndarray, width: int, height: int) -> np.ndarray:
+    # Nearest neighbour, all textures are assumed to share the same UV space
+    rows = np.arange(height) * pixels.shape[0] // height
+    cols = np.arange(width) * pixels.shape[1] // width
+    return pixels[rows][:, cols]
+
+def bakeCombiners(m: Material, textures: dict, width: int, height: int) -> tuple[np.ndarray, bool]:
+    # textures maps the texture mapper index to its (h, w, 4) float pixels.
+    # Vertex colour is taken as white and reported, so it can be multiplied back in afterwards.
+    sources = {}
+    for i, pixels in textures.items():
+        pixels = resample(pixels, width, height)
+        sources[i] = (pixels[..., :3], pixels[..., 3:4])
+    white = getConstant([1.0, 1.0, 1.0, 1.0])
+    buffer = getConstant([b/255.0 for b in m.bufferColor])
+    diffuse = getConstant([b/255.0 for b in m.diffuseColor])
+    secondary = getConstant([0.0, 0.0, 0.0, 1.0])
+    usesVertexColour = False
+    outputs = []
+
+    def getSource(stageIdx: int, stage: Combiner, sourceType: TexCombinerSource) -> tuple:
+        nonlocal usesVertexColour
+        match sourceType:
+            case TexCombinerSource.Texture0:
+                return sources[0]
+            case TexCombinerSource.Texture1:
+                return sources[1]
+            case TexCombinerSource.Texture2:
+                return sources[2]
+            case TexCombinerSource.Texture3:
+                return sources[3]
+            case TexCombinerSource.PrimaryColor:
+                usesVertexColour = True
+                return white
+            case TexCombinerSource.Constant:
+                return getConstant([c/255.0 for c in m.constantColors[stage.constColorIndex]])
+            case TexCombinerSource.Previous:
+                return outputs[stageIdx - 1] if stageIdx >= 1 else buffer
+            case TexCombinerSource.PreviousBuffer:
+                return outputs[stageIdx - 2] if stageIdx >= 2 else buffer
+            case TexCombinerSource.FragmentPrimaryColor:
+                return diffuse
+            case TexCombinerSource.FragmentSecondaryColor:
+                return secondary
+
+    for stageIdx, stage in enumerate(m.texEnvStages[:m.texEnvStageCount]):
+        colourSources = (stage.sourceColor0, stage.sourceColor1, stage.sourceColor2)
+        colourOperands = (stage.operandColor0, stage.operandColor1, stage.operandColor2)
+        colourValues = [getOperand(getSource(stageIdx, stage, colourSources[i]), colourOperands[i])
+                        for i in range(getSourceCount(stage.combinerModeColor))]
+
+        alphaSources = (stage.sourceAlpha0, stage.sourceAlpha1, stage.sourceAlpha2)
+        alphaOperands = (stage.operandAlpha0, stage.operandAlpha1, stage.operandAlpha2)
+        alphaValues = [getOperand(getSource(stageIdx, stage, alphaSources[i]), alphaOperands[i])
+                       for i in range(getSourceCount(stage.combinerModeAlpha))]
+
+        colour = getModeOutput(stage.combinerModeColor, colourValues) * float(stage.scaleColor)
+        alpha = getModeOutput(stage.combinerModeAlpha, alphaValues) * float(stage.scaleAlpha)
+        if alpha.shape[-1] == 3:
+            alpha = np.sum(alpha * LuminanceWeights, axis=-1, keepdims=True)
+        outputs.append((colour, alpha))
+
+    colour, alpha = outputs[-1] if len(outputs) > 0 else buffer
+    result = np.empty((height, width, 4), dtype=np.float32)
+    result[..., :3] = np.broadcast_to(colour, (height, width, 3))
+    result[..., 3:] = np.broadcast_to(alpha, (height, width, 1))
+    return np.clip(result, 0.0, 1.0), usesVertexColour
@@ -1,9 +1,8 @@
-import io, os, bpy
+import io, os, hashlib
 
 from io import BufferedReader
-from .utils import *
+from .binary import *
 from .cmbEnums import GLTextureFormat
-from .ctrTexture import DecodeBuffer
 
 class CTXB:
 
@@ -45,36 +44,10 @@ class Texture:
         self.DataOffset = readUInt32(f)
         self.Name = readString(f, 16)
         
-def loadCtxb(file: BufferedReader, folderName: str, fileName: str):
-    try:
-        ctxb = CTXB(file)
 
-        for chunk in ctxb.Chunks:
-            for t in chunk.Textures:
-                name = t.Name if t.Name != "" else os.path.splitext(fileName)[0]
-                format = t.TextureFormat
-                imagePath = os.path.join(folderName, f"{name}.png")
-                if os.path.exists(imagePath):
-                    continue
-                
-                image = bpy.data.images.new(t.Name, t.Width, t.Height, alpha=True)
-                image.pixels = DecodeBuffer(t.Data, t.Width, t.Height, format, format is GLTextureFormat.ETC1a4 or format is GLTextureFormat.ETC1)
-                image.update()  # Updates the display image                
-                image.filepath_raw = imagePath
-                image.file_format = 'PNG'
-                image.save()
+def getImageKey(data: bytes, width: int, height: int, format: GLTextureFormat) -> str:
+    # Identifies a decoded image, however many files embed the same texture data
+    return hashlib.sha1(data).hexdigest() + f"_{width}x{height}_{int(format)}"
 
-    except Exception as ex:
-        print("Failed to load CTXB file")
-        print(ex)
-
-def loadCtxbFiles(operator):
-    root = get_or_add_root()
-
-    dirname = os.path.dirname(operator.filepath)
-    for file in operator.files:
-        path = os.path.join(dirname, file.name)
-        with open(path, "rb") as f:
-            loadCtxb(f, os.path.dirname(path), file.name)
-
-    return {"FINISHED"}
\ No newline at end of file
+def isETC1Format(format: GLTextureFormat) -> bool:
+    return format is GLTextureFormat.ETC1a4 or format is GLTextureFormat.ETC1
@@ -1,8 +1,7 @@
 import io, os
 
 from io import BufferedReader
-from .utils import *
-from .ctxb import loadCtxb
+from .binary import *
 
 class SystemFileGroup:
 
@@ -38,13 +37,25 @@ class FileInfo:
         self.Name = None if isZarFormat else readOffsetString(f,readUInt32(f))
         tokens = os.path.splitext(readOffsetString(f,readUInt32(f)))
         self.FileName = tokens[0]
-        self.Ext = tokens[1]
+        self.Ext = tokens[1].lstrip(".")
 
 class FileEntry:
-    def __init__(self, name, ext, data):
+    # Only the location is kept, the data is read from the archive when it's asked for
+    def __init__(self, reader: BufferedReader, name, ext, offset, size):
+        self.Reader = reader
         self.FileName = name
         self.Ext = ext
-        self.Data = data
+        self.Offset = offset
+        self.Size = size
+
+    @property
+    def Data(self) -> bytes:
+        self.Reader.seek(self.Offset, io.SEEK_SET)
+        return self.Reader.read(self.Size)
+
+    def open(self) -> MemoryReader:
+        # A slice of the archive's own buffer when it's memory backed, so nothing is copied
+        return MemoryReader(self.Data)
 
 class GAR:
     class VersionMagic:
@@ -95,10 +106,9 @@ class GAR:
             for _ in range(self.FileGroups[i].FileCount):
                 self.FileInfos.append(SystemFileInfo(f, self.FileGroups[i].Name))
 
-        f.seek(self.DataOffset)
         for i in range(self.FileCount):
             info = self.FileInfos[i]
-            self.Files.append(FileEntry(info.Name, info.Ext, self.getSection(f, info.DataOffset, info.DataSize)))
+            self.Files.append(FileEntry(f, info.Name, info.Ext, info.DataOffset, info.DataSize))
 
     def readZeldaArchive(self, f: BufferedReader):
         f.seek(self.FileGroupOffset)
@@ -110,63 +120,15 @@ class GAR:
 
         f.seek(self.FileInfoOffset)
         for i in range(self.FileGroupCount):
-            for f in range(self.FileGroups[i].FileCount):
+            for _ in range(self.FileGroups[i].FileCount):
                 self.FileInfos.append(FileInfo(f, self.Version == self.VersionMagic.ZAR1))
 
         f.seek(self.DataOffset)
         Offsets = readArray(f, self.FileCount, DataTypes.UInt)
         for i in range(len(self.FileInfos)):
-            self.Files.append(FileEntry(self.FileInfos[i].FileName, self.getSection(f, Offsets[i], self.FileInfos[i].DataSize)))
-    
-    def getSection(self, f: BufferedReader, offset, size):
-        f.seek(offset, io.SEEK_SET)
-        return f.read(size)
-
-def loadGar(garReader: BufferedReader, folderName, collection, parent):
-    gar = GAR(garReader)
-
-    firstModel = None
-    group = None
-    
-    for file in reversed(gar.Files):
-        if file.Ext == "ctxb":
-            if not os.path.exists(folderName):
-                os.mkdir(folderName)
-
-            loadCtxb(io.BufferedReader(io.BytesIO(file.Data)), folderName, file.FileName)
-
-        if file.Ext == "cmb":
-            from .import_cmb import loadCmbSafe
-            model = loadCmbSafe(io.BufferedReader(io.BytesIO(file.Data)), file.FileName, folderName, collection, parent)
-            if firstModel == None:
-                firstModel = model
-            else:
-                if group == None:
-                    group = bpy.data.objects.new(folderName.replace(os.path.dirname(folderName),"").strip(os.path.sep), None)
-                    collection.objects.link(group)
-                    group.parent = parent
-                    firstModel.parent = group
-                model.parent = group
-
-        if file.Ext == "gar":
-            childFolderName = os.path.join(folderName, file.FileName.replace("_tex", ""))
-            if not os.path.exists(folderName):
-                os.mkdir(folderName)
-            loadGar(io.BufferedReader(io.BytesIO(file.Data)), childFolderName, collection, parent)
-
-    return firstModel if group == None else group
-    
-def loadGarFiles(operator):
-    root = get_or_add_root()
-    
-    dirname = os.path.dirname(operator.filepath)
-    for file in operator.files:
-        path = os.path.join(dirname, file.name)
-        
-        folderName = os.path.splitext(path)[0]
-        if not os.path.exists(folderName):
-            os.mkdir(folderName)
-        with open(path, "rb") as reader:
-            loadGar(reader, folderName, bpy.context.scene.collection, root)
+            info = self.FileInfos[i]
+            self.Files.append(FileEntry(f, info.FileName, info.Ext, Offsets[i], info.DataSize))
 
-    return {"FINISHED"}
\ No newline at end of file
+    def __iter__(self):
+        # Entries in the order their data is stored, so reading them all only ever seeks forwards
+        return iter(sorted(self.Files, key=lambda file: file.Offset))
@@ -0,0 +1,141 @@
+import os, sys, struct, zlib, fnmatch, argparse
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .binary import MemoryReader, openMapped
+from .gar import GAR
+from .ctxb import CTXB, isETC1Format
+from .ctrTexture import DecodeBuffer
+
+# Lists and extracts GAR/ZAR archives without Blender, e.g.
+#   python -m io_scene_cmb.garTool extract romfs/actor -o out --ext cmb ctxb --recursive --decode-textures
+
+ArchiveExts = ("gar", "zar")
+
+def findArchives(paths: list[str]):
+    # Yields (archive path, path relative to the folder it was found in)
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+
+        for dirpath, _, fileNames in os.walk(path):
+            for fileName in sorted(fileNames):
+                if os.path.splitext(fileName)[1].lstrip(".").lower() in ArchiveExts:
+                    archivePath = os.path.join(dirpath, fileName)
+                    yield archivePath, os.path.relpath(archivePath, path)
+
+def iterEntries(gar: GAR, prefix: str, recursive: bool):
+    # Yields (path inside the archive, entry) in file order, descending into nested archives
+    for entry in gar:
+        path = f"{prefix}{entry.FileName}.{entry.Ext}"
+        if recursive and entry.Ext in ArchiveExts:
+            yield from iterEntries(GAR(entry.open()), f"{prefix}{entry.FileName}/", recursive)
+        else:
+            yield path, entry
+
+def isIncluded(path: str, patterns: list[str], exts: list[str]) -> bool:
+    ext = os.path.splitext(path)[1].lstrip(".")
+    if exts and ext not in exts:
+        return False
+    return not patterns or any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(os.path.basename(path), p) for p in patterns)
+
+def writePng(path: str, pixels: list[float], width: int, height: int):
+    # Pixels are floats bottom row first, as they're decoded for Blender
+    data = bytes(max(0, min(255, round(v * 255))) for v in pixels)
+    stride = width * 4
+    rows = b"".join(b"\x00" + data[y * stride:(y + 1) * stride] for y in reversed(range(height)))
+
+    def chunk(tag: bytes, body: bytes) -> bytes:
+        return struct.pack(">I", len(body)) + tag + body + struct.pack(">I", zlib.crc32(tag + body))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(rows)))
+        f.write(chunk(b"IEND", b""))
+
+def decodeCtxb(data: bytes, folderName: str, fileName: str) -> list[str]:
+    # Runs in a worker process, so it takes a copy of the data rather than a view of the archive
+    ctxb = CTXB(MemoryReader(data))
+    written = []
+    for chunk in ctxb.Chunks:
+        for t in chunk.Textures:
+            name = t.Name if t.Name != "" else fileName
+            format = t.TextureFormat
+            pixels = DecodeBuffer(t.Data, t.Width, t.Height, format, isETC1Format(format))
+            imagePath = os.path.join(folderName, f"{name}.png")
+            writePng(imagePath, pixels, t.Width, t.Height)
+            written.append(imagePath)
+    return written
+
+def writeEntry(path: str, data: memoryview):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def listArchive(archivePath: str, args):
+    gar = GAR(openMapped(archivePath))
+    for path, entry in iterEntries(gar, "", args.recursive):
+        if isIncluded(path, args.include, args.ext):
+            print(f"{entry.Size:>10}  {archivePath}:{path}")
+
+def extractArchive(archivePath: str, outFolder: str, args, writers: ThreadPoolExecutor, decoders: ProcessPoolExecutor) -> list:
+    gar = GAR(openMapped(archivePath))
+    jobs = []
+    for path, entry in iterEntries(gar, "", args.recursive):
+        if not isIncluded(path, args.include, args.ext):
+            continue
+
+        outPath = os.path.join(outFolder, *path.split("/"))
+        os.makedirs(os.path.dirname(outPath), exist_ok=True)
+
+        if args.decode_textures and entry.Ext == "ctxb":
+            jobs.append((path, decoders.submit(decodeCtxb, bytes(entry.Data), os.path.dirname(outPath), entry.FileName)))
+        else:
+            jobs.append((path, writers.submit(writeEntry, outPath, entry.Data)))
+    return jobs
+
+def main(argv: list[str] = None) -> int:
+    parser = argparse.ArgumentParser(prog="garTool", description="List or extract Grezzo GAR/ZAR archives")
+    parser.add_argument("command", choices=["list", "extract"])
+    parser.add_argument("paths", nargs="+", help="Archives, or folders to search for archives")
+    parser.add_argument("-o", "--output", default=".", help="Folder to extract into, one sub-folder per archive")
+    parser.add_argument("-i", "--include", nargs="*", default=[], help="Glob patterns matched against entry paths or names")
+    parser.add_argument("-e", "--ext", nargs="*", default=[], help="Only entries with these extensions, e.g. cmb ctxb")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Extract the contents of nested archives")
+    parser.add_argument("-d", "--decode-textures", action="store_true", help="Write .ctxb textures as PNG images")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of worker threads/processes")
+    args = parser.parse_args(argv)
+
+    failures = 0
+    if args.command == "list":
+        for archivePath, _ in findArchives(args.paths):
+            try:
+                listArchive(archivePath, args)
+            except Exception as ex:
+                print(f"Failed to read {archivePath}: {ex}", file=sys.stderr)
+                failures += 1
+        return 1 if failures else 0
+
+    with ThreadPoolExecutor(args.jobs) as writers, ProcessPoolExecutor(args.jobs) as decoders:
+        for archivePath, relativePath in findArchives(args.paths):
+            try:
+                outFolder = os.path.join(args.output, os.path.splitext(relativePath)[0])
+                jobs = extractArchive(archivePath, outFolder, args, writers, decoders)
+            except Exception as ex:
+                print(f"Failed to read {archivePath}: {ex}", file=sys.stderr)
+                failures += 1
+                continue
+
+            # Wait for this archive's jobs so its mapping can be released before the next one
+            for path, job in jobs:
+                try:
+                    job.result()
+                except Exception as ex:
+                    print(f"Failed to extract {archivePath}:{path}: {ex}", file=sys.stderr)
+                    failures += 1
+            print(f"{archivePath}: {len(jobs)} entries")
+
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
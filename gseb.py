@@ -1,9 +1,15 @@
-import os, math
+import os, math, types
+import numpy as np
 
 from enum import IntEnum
 from .utils import *
-from .gar import loadGar
-from .import_cmb import loadCmb
+from .import_gar import loadGar, printDuplicates, tagProxy
+from .import_cmb import loadCmb, buildSkeletons
+from .session import ImportSession
+from .catalog import getCatalog, findRomFSRoot
+from .prefetch import iterPrefetch, shutdownDecoders
+from .spatial import SpatialGrid
+from . import profiling
 
 class DataType(IntEnum):    
     UInt = 0, 
@@ -20,47 +26,232 @@ class SceneField(object):
         f.seek(f.tell()+1)
         self.type = DataType(readUByte(f))
 
-class SceneObj(object):
-    def __init__(self, f, fields: list[SceneField], endOffset):
-        
-        self.boundsDimensions = [0, 0, 0]
-        self.position = [0, 0, 0]
-        self.rotation = [0, 0, 0]
+class SceneLayout(object):
+    # The field table is the same for every record of a file, so it's turned into a
+    # NumPy record type once and all of the records are decoded in one go
+    def __init__(self, fields: list[SceneField], itemSize: int):
+        base = fields[0].offset if len(fields) > 0 else 0
+        columns = {}
+        self.fromMdlFolder = False
 
-        field_iterator = zip(fields, [field.offset for field in fields[1:]] + [endOffset])
-
-        for field, next_offset in field_iterator:
-            size = next_offset - field.offset
+        for field, nextOffset in zip(fields, [field.offset for field in fields[1:]] + [itemSize]):
+            size = nextOffset - field.offset
             match (field.id1, field.id2, field.id3):
                 case (198, 117, 97) | (59, 121, 121):
-                    self.modelName = readString(f, size)
+                    columns["modelName"] = (f"S{size}", field.offset - base)
                     self.fromMdlFolder = True
                 case (205, 200, 155):
-                    self.modelName = readString(f, size)
+                    columns["modelName"] = (f"S{size}", field.offset - base)
                 case (45, 149, 201):
-                    self.roomNo = readUInt32(f)
+                    columns["roomNo"] = ("<u4", field.offset - base)
                 case (129, 110, 114):
-                    self.verticalOffset = readFloat(f)
+                    columns["verticalOffset"] = ("<f4", field.offset - base)
                 case (170 | 171 | 172, 92, 84):
-                    self.boundsDimensions[field.id1-170] = readUInt32(f)
+                    columns[f"bounds{field.id1-170}"] = ("<u4", field.offset - base)
                 case (217 | 218 | 219, 239, 123):
-                    self.position[field.id1-217] = readFloat(f)
+                    columns[f"position{field.id1-217}"] = ("<f4", field.offset - base)
                 case (100 | 101 | 102, 5, 122):
-                    self.rotation[field.id1-100] = readFloat(f)
-                case _:
-                    f.seek(f.tell() + size)
+                    columns[f"rotation{field.id1-100}"] = ("<f4", field.offset - base)
+
+        self.dtype = np.dtype({
+            "names": list(columns.keys()),
+            "formats": [format for format, _ in columns.values()],
+            "offsets": [offset for _, offset in columns.values()],
+            "itemsize": itemSize - base,
+        })
+
+class SceneTable(object):
+    # Columns of every record in the file, missing fields are left as zeros (or None)
+    def __init__(self, f, layout: SceneLayout, count: int):
+        records = np.frombuffer(f.read(count * layout.dtype.itemsize), dtype=layout.dtype, count=count)
+        names = records.dtype.names or ()
+        self.count = count
+        self.fromMdlFolder = layout.fromMdlFolder
+
+        def getVectors(prefix: str, dtype) -> np.ndarray:
+            columns = [records[f"{prefix}{i}"] if f"{prefix}{i}" in names else np.zeros(count, dtype) for i in range(3)]
+            return np.stack(columns, axis=1).astype(dtype)
+
+        self.position = getVectors("position", np.float32)
+        self.rotation = getVectors("rotation", np.float32)
+        self.bounds = getVectors("bounds", np.uint32)
+        self.roomNo = records["roomNo"].copy() if "roomNo" in names else None
+        self.verticalOffset = records["verticalOffset"].copy() if "verticalOffset" in names else None
+        self.modelName = ([name.decode("ASCII").replace("\x00", '') for name in records["modelName"].tolist()]
+                          if "modelName" in names else ["(null)"] * count)
+        self._index = None
+
+    @property
+    def index(self) -> SpatialGrid:
+        # Built on the first region or nearest query, as most imports don't make one
+        if self._index is None:
+            self._index = SpatialGrid(self.position, self.bounds)
+        return self._index
+
+    def select(self, rooms: set = None, region: tuple = None) -> np.ndarray:
+        # Indices of the placed records in the given rooms whose bounds overlap the (min, max)
+        # region. Bounds are treated as axis aligned boxes around the position, ignoring rotation.
+        mask = np.any(self.position != 0, axis=1) | np.any(self.rotation != 0, axis=1)
+        if rooms is not None and self.roomNo is not None:
+            mask &= np.isin(self.roomNo, list(rooms))
+        if region is not None:
+            inRegion = np.zeros(self.count, dtype=bool)
+            inRegion[self.index.queryRegion(*region)] = True
+            mask &= inRegion
+        return np.flatnonzero(mask)
+
+class SceneObj(object):
+    def __init__(self, table: SceneTable, index: int):
+        self.modelName = table.modelName[index]
+        self.fromMdlFolder = table.fromMdlFolder
+        self.boundsDimensions = table.bounds[index].tolist()
+        self.position = table.position[index].tolist()
+        self.rotation = table.rotation[index].tolist()
+        if table.roomNo is not None:
+            self.roomNo = int(table.roomNo[index])
+        if table.verticalOffset is not None:
+            self.verticalOffset = float(table.verticalOffset[index])
+
+InstanceSourcesName = "Instanced Models"
+
+# SceneTable of each GSEB file read so far, keyed by its absolute path, with the (mtime, size)
+# it was read at. Kept after the import for findSceneObjects and findNearestSceneObjects.
+sceneTables = {}
 
-def loadGseb(f, folderName, root):
+def readSceneTable(f) -> SceneTable:
     numItems = readUInt32(f)
     numFields = readUInt32(f)
     itemsOff = readUInt32(f)
     itemSize = readUInt32(f)
     fields = [SceneField(f) for _ in range(numFields)]
-    scene = [SceneObj(f, fields, itemSize) for _ in range(numItems)]
+    return SceneTable(f, SceneLayout(fields, itemSize), numItems)
+
+def getSceneTable(path: str, f = None) -> SceneTable:
+    # Read from f (or the file at path) only if the file changed since it was last read
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    version = (stat.st_mtime, stat.st_size)
+    cached = sceneTables.get(path)
+    if cached is None or cached[0] != version:
+        if f is None:
+            with open(path, "rb") as f:
+                table = readSceneTable(f)
+        else:
+            table = readSceneTable(f)
+        cached = sceneTables[path] = (version, table)
+    return cached[1]
+
+def findSceneObjects(path: str, low, high, rooms: set = None) -> list[SceneObj]:
+    # The placed objects of a GSEB file whose bounds overlap the (low, high) region, in file units
+    table = getSceneTable(path)
+    return [SceneObj(table, i) for i in table.select(rooms, (low, high))]
+
+def findNearestSceneObjects(path: str, point, count: int = 1) -> list[SceneObj]:
+    # The count objects of a GSEB file placed nearest the point, nearest first
+    table = getSceneTable(path)
+    return [SceneObj(table, i) for i in table.index.queryNearest(point, count).tolist()]
+
+def getModelFolder(obj: SceneObj, romFSpath: str, mapNo: int) -> str:
+    # Path of the model without its extension, which is also where its textures are saved
+    if (obj.fromMdlFolder):
+        return os.path.join(romFSpath, "model", obj.modelName)
+    return os.path.join(romFSpath, "mapmdl", f"map{mapNo}", f"room_{str(obj.roomNo).zfill(2)}", obj.modelName)
+
+def parseRoomList(text: str) -> set[int]:
+    # e.g. "0, 3, 5-7"
+    rooms = set()
+    for token in text.replace(" ", "").split(","):
+        if token == "":
+            continue
+        first, _, last = token.partition("-")
+        try:
+            rooms.update(range(int(first), int(last or first) + 1))
+        except ValueError:
+            print(f"Warning: Ignoring invalid room '{token}'")
+    return rooms
+
+def loadModel(modelPath: str, folderName: str, collection, parent, session: ImportSession):
+    with profiling.file(modelPath):
+        if modelPath.endswith(".cmb"):
+            with open(modelPath, "rb") as reader:
+                model = loadCmb(reader, folderName, collection, parent, session)
+        else:
+            model = loadGar(openMapped(modelPath), folderName, collection, parent, session)
+
+    if model != None and session.proxyMode != 'NONE':
+        tagProxy(model, modelPath, folderName, session)
+    return model
+
+def getInstanceSources():
+    sources = bpy.data.collections.get(InstanceSourcesName)
+    if not sources:
+        sources = bpy.data.collections.new(InstanceSourcesName)
+        bpy.context.scene.collection.children.link(sources)
+    return sources
+
+def getModelInstance(modelPath: str, folderName: str, name: str, collection, session: ImportSession):
+    # Each model is only loaded once, into a collection that every scene object using it instances
+    if modelPath not in session.instanceSources:
+        source = bpy.data.collections.new(name)
+        getInstanceSources().children.link(source)
+        model = loadModel(modelPath, folderName, source, None, session)
+        session.instanceSources[modelPath] = source if model != None else None
+
+    source = session.instanceSources[modelPath]
+    if source is None:
+        return None
+
+    instance = bpy.data.objects.new(name, None)
+    instance.instance_type = 'COLLECTION'
+    instance.instance_collection = source
+    collection.objects.link(instance)
+    if session.proxyMode != 'NONE':
+        tagProxy(instance, modelPath, folderName, session)
+    return instance
+
+def hideInstanceSources():
+    # Only once the skeletons are built, as edit mode needs the armatures to be in the view layer
+    def findLayer(layer):
+        if layer.name == InstanceSourcesName:
+            return layer
+        for child in layer.children:
+            found = findLayer(child)
+            if found:
+                return found
+        return None
+
+    layer = findLayer(bpy.context.view_layer.layer_collection)
+    if layer:
+        layer.exclude = True
+
+def loadGseb(f, folderName, root, session: ImportSession = None, rooms: set = None, region: tuple = None):
+    runSteps(iterGseb(f, folderName, root, session, rooms, region))
+
+def iterGseb(f, folderName, root, session: ImportSession = None, rooms: set = None, region: tuple = None):
+    ownsSession = session is None
+    session = session or ImportSession()
+    table = getSceneTable(f.name, f) if hasattr(f, "name") else readSceneTable(f)
+    # Filtered before any model is looked at, so only the selection costs anything to import
+    scene = [SceneObj(table, i) for i in table.select(rooms, region)]
     mapNo = int(os.path.basename(folderName)[3:])
     romFSpath = os.path.dirname(os.path.dirname(folderName))
+    catalog = getCatalog(session, romFSpath)
+
+    # The prefetch is the first half of the progress, placing the objects the second
+    stages = 1
+    if session.prefetchModels:
+        modelPaths = {}
+        for obj in scene:
+            if obj.modelName != "(null)":
+                path = getModelFolder(obj, romFSpath, mapNo)
+                modelPath = catalog.findModel(path)
+                if modelPath is not None and modelPath not in session.instanceSources:
+                    modelPaths.setdefault(modelPath, path)
+        with profiling.stage("prefetch", items=len(modelPaths)):
+            yield from scaleSteps(iterPrefetch(list(modelPaths.items()), session), 0, 2)
+        stages = 2
 
-    for obj in scene:
+    for i, obj in enumerate(scene):
         if hasattr(obj, "roomNo"):
             roomCollection = bpy.data.collections.get(f"Room {obj.roomNo}")
             if not roomCollection:
@@ -68,9 +259,6 @@ def loadGseb(f, folderName, root):
                 bpy.context.scene.collection.children.link(roomCollection)
         else:
             roomCollection = bpy.context.scene.collection
-
-        if obj.position == [0,0,0] and obj.rotation == [0,0,0]:
-            continue
         
         bounds = bpy.data.objects.new(f"{obj.modelName}.bounds", None)
         roomCollection.objects.link(bounds)
@@ -79,22 +267,14 @@ def loadGseb(f, folderName, root):
         model = None
         
         if obj.modelName != "(null)":
-            if (obj.fromMdlFolder):
-                path = os.path.join(romFSpath, "model", obj.modelName)
-            else:
-                path = os.path.join(romFSpath, "mapmdl", f"map{mapNo}", f"room_{str(obj.roomNo).zfill(2)}", obj.modelName)
-
-            if os.path.exists(f"{path}.cmb"):
-                with open(f"{path}.cmb", "rb") as reader:
-                    model = loadCmb(reader, path, roomCollection, parent)
-            elif os.path.exists(f"{path}.zar"):
-                with open(f"{path}.zar", "rb") as reader:
-                    model = loadGar(reader, path, roomCollection, parent)
-            elif os.path.exists(f"{path}.gar"):
-                with open(f"{path}.gar", "rb") as reader:
-                    model = loadGar(reader, path, roomCollection, parent)
-            else:
+            path = getModelFolder(obj, romFSpath, mapNo)
+            modelPath = catalog.findModel(path)
+            if modelPath is None:
                 print(f"Warning: File '{path}' does not exist.")
+            elif session.instanceModels:
+                model = getModelInstance(modelPath, path, obj.modelName, roomCollection, session)
+            else:
+                model = loadModel(modelPath, path, roomCollection, parent, session)
 
         if model != None:
             model.parent = root
@@ -112,14 +292,136 @@ def loadGseb(f, folderName, root):
         #bounds.matrix_local = bounds.matrix_local @ mathutils.Matrix.Translation(Vector([0,obj.boundsDimensions[1]/2,0]))            
         if obj.boundsDimensions != [0,0,0]:
             bounds.scale = Vector(obj.boundsDimensions)
+        yield (stages - 1 + (i + 1) / len(scene)) / stages
+
+    if ownsSession:
+        shutdownDecoders(session)
+        buildSkeletons(session)
+        hideInstanceSources()
+        printDuplicates(session)
 
 def loadGsebFiles(operator):
+    runSteps(iterGsebFiles(operator))
+    return {"FINISHED"}
+
+def iterGsebFiles(operator):
     root = get_or_add_root()
+    session = ImportSession(operator)
+    profiling.start(session.profile)
+
+    rooms = parseRoomList(operator.rooms) if operator.rooms.strip() != "" else None
+    region = (tuple(operator.region_min), tuple(operator.region_max)) if operator.use_region else None
 
     dirname = os.path.dirname(operator.filepath)
-    for file in operator.files:
-        path = os.path.join(dirname, file.name)
-        with open(path, "rb") as f:
-            loadGseb(f, os.path.dirname(path), root)
+    try:
+        for i, file in enumerate(operator.files):
+            path = os.path.join(dirname, file.name)
+            with open(path, "rb") as f, profiling.file(path):
+                yield from scaleSteps(iterGseb(f, os.path.dirname(path), root, session, rooms, region), i, len(operator.files))
+    finally:
+        # Also when the import is cancelled, so the objects placed so far are complete
+        shutdownDecoders(session)
+        buildSkeletons(session)
+        hideInstanceSources()
+        printDuplicates(session)
+        profiling.finish(session.profileJson)
 
-    return {"FINISHED"}
+def findProxyRoot(obj):
+    # The object the proxy's model path is on: the proxy itself for instances, otherwise
+    # the model's armature or GAR group above the proxy meshes
+    while obj is not None and obj.get("cmb_proxy_path") is None:
+        obj = obj.parent
+    return obj
+
+def removeInstanceSource(source):
+    # Removes a model loaded for instancing, with its meshes, once nothing instances it any more
+    if any(obj.instance_collection == source for obj in bpy.data.objects):
+        return
+    for obj in list(source.all_objects):
+        data = obj.data
+        bpy.data.objects.remove(obj)
+        if data is not None and data.users == 0:
+            if isinstance(data, bpy.types.Mesh):
+                bpy.data.meshes.remove(data)
+            elif isinstance(data, bpy.types.Armature):
+                bpy.data.armatures.remove(data)
+    bpy.data.collections.remove(source)
+
+def findFullSource(modelPath: str, options: str):
+    # A full model loaded for instancing by an earlier replaceProxies, so it isn't loaded again
+    for source in getInstanceSources().children:
+        if source.get("cmb_model_path") == modelPath and source.get("cmb_model_options") == options:
+            return source
+    return None
+
+def replaceProxies(context) -> int:
+    # Loads the full model for each selected proxy. Instances are pointed at a full copy of
+    # their model, other proxies are removed and the full model takes over their transform.
+    # Returns how many proxies were replaced.
+    sessions = {}  # One per set of import options, as proxies from different imports can be selected together
+    sources = {}
+    newSources = []
+    oldSources = set()
+    replaced = 0
+
+    # Selecting any part of a proxy (usually one of its meshes) replaces the whole model, once
+    roots = {}
+    for obj in context.selected_objects:
+        root = findProxyRoot(obj)
+        if root is not None:
+            roots[root.name] = root
+    # Roots inside another selected root are removed along with it
+    roots = [root for root in roots.values() if findProxyRoot(root.parent) not in roots.values()]
+
+    for obj in roots:
+        modelPath = obj.get("cmb_proxy_path")
+        folderName = obj.get("cmb_proxy_folder")
+        options = obj.get("cmb_proxy_options")
+        options = options.to_dict() if options is not None else {}
+        optionsKey = tuple(sorted(options.items()))
+        if optionsKey not in sessions:
+            sessions[optionsKey] = ImportSession(types.SimpleNamespace(**options))
+        session = sessions[optionsKey]
+        # So textures the model only names are found in the rest of the dump, as in the original import
+        getCatalog(session, findRomFSRoot(modelPath))
+
+        if obj.instance_type == 'COLLECTION' and obj.instance_collection is not None:
+            if (modelPath, optionsKey) not in sources:
+                source = sources[(modelPath, optionsKey)] = findFullSource(modelPath, repr(optionsKey))
+                if source is None:
+                    # Kept in the view layer until the skeletons are built
+                    source = sources[(modelPath, optionsKey)] = bpy.data.collections.new(obj.instance_collection.name)
+                    source["cmb_model_path"] = modelPath
+                    source["cmb_model_options"] = repr(optionsKey)
+                    context.scene.collection.children.link(source)
+                    loadModel(modelPath, folderName, source, None, session)
+                    newSources.append(source)
+            oldSources.add(obj.instance_collection.name)
+            obj.instance_collection = sources[(modelPath, optionsKey)]
+            del obj["cmb_proxy_path"]
+            del obj["cmb_proxy_folder"]
+            if "cmb_proxy_options" in obj:
+                del obj["cmb_proxy_options"]
+        else:
+            model = loadModel(modelPath, folderName, obj.users_collection[0], obj.parent, session)
+            if model == None:
+                continue
+            model.matrix_local = obj.matrix_local.copy()
+            for child in obj.children:
+                if not child.get("cmb_proxy"):
+                    child.parent = model  # e.g. the scene object's bounds
+            proxies = [obj] + [child for child in obj.children_recursive if child.get("cmb_proxy")]
+            for proxy in proxies:
+                bpy.data.objects.remove(proxy)
+        replaced += 1
+
+    for session in sessions.values():
+        buildSkeletons(session)
+    for source in newSources:
+        context.scene.collection.children.unlink(source)
+        getInstanceSources().children.link(source)
+    # The proxy models that no other proxy instances any more
+    for name in oldSources:
+        removeInstanceSource(bpy.data.collections[name])
+    hideInstanceSources()
+    return replaced
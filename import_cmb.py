@@ -1,34 +1,54 @@
-import os, array, bpy, bmesh, io
+import os, bpy, bmesh, io
+import numpy as np
 
 from .cmb import *
 from .utils import *
-from .ctrTexture import DecodeBuffer
+from .import_ctxb import decodeImage, findImage, findCatalogImage
 from .materials import generateMaterial
+from .session import ImportSession
+from . import profiling
 
 # TODO: Clean up
 
 def loadCmbFiles(operator):
+    runSteps(iterCmbFiles(operator))
+    return {"FINISHED"}
+
+def iterCmbFiles(operator):
     root = get_or_add_root()
+    session = ImportSession(operator)
+    profiling.start(session.profile)
 
     dirname = os.path.dirname(operator.filepath)
-    for file in operator.files:
-        path = os.path.join(dirname, file.name)
-        with open(path, "rb") as f:
-            loadCmbSafe(f, os.path.split(path)[0], file.name, bpy.context.collection, root)
-
-    return {"FINISHED"}
-
-def loadCmbSafe(f: io.BufferedReader, folderName: str, fileName: str, collection, parent):
     try:
-        loadCmb(f, folderName, collection, parent)        
+        for i, file in enumerate(operator.files):
+            path = os.path.join(dirname, file.name)
+            with open(path, "rb") as f, profiling.file(path):
+                loadCmbSafe(f, os.path.split(path)[0], file.name, bpy.context.collection, root, session)
+            yield (i + 1) / len(operator.files)
+    finally:
+        # Also when the import is cancelled, so the models loaded so far get their bones
+        buildSkeletons(session)
+        profiling.finish(session.profileJson)
+
+def loadCmbSafe(f: io.BufferedReader, folderName: str, fileName: str, collection, parent, session: ImportSession = None, contentHash: str = None):
+    try:
+        return loadCmb(f, folderName, collection, parent, session, contentHash)
     except Exception as ex:
         print(f"Failed to load CMB {fileName}")
         print(ex)
 
-def loadCmb(f: io.BufferedReader, folderName, collection, parent):
-    cmb = readCmb(f)
-    vb = cmb.vatr  # VertexBufferInfo
-    boneTransforms = {}
+def loadCmb(f: io.BufferedReader, folderName, collection, parent, session: ImportSession = None, contentHash: str = None):
+    # contentHash is the SHA-1 of the file, if the caller already has it (e.g. from the archive's dedup)
+    ownsSession = session is None
+    session = session or ImportSession()
+    contentHash = contentHash or getContentHash(f)
+    cmb = session.models.get(contentHash)
+    if cmb is None:
+        with profiling.stage("readCmb") as stage:
+            cmb = session.models[contentHash] = readCmb(f)
+            stage.count(bytes=cmb.fileSize, items=len(cmb.meshes))
+    isProxy = session.proxyMode != 'NONE'
 
     # ################################################################
     # Build skeleton
@@ -39,58 +59,40 @@ def loadCmb(f: io.BufferedReader, folderName, collection, parent):
     skl_obj = bpy.data.objects.new(cmb.name, skeleton)
     skl_obj.show_in_front = True
     collection.objects.link(skl_obj)  # Link armature to the scene
-    bpy.context.view_layer.objects.active = skl_obj  # Select the skeleton for editing
-    bpy.ops.object.mode_set(mode='EDIT')  # Set to edit mode
-
-    for bone in cmb.skeleton:
-        # Save the matrices so we don't have to recalculate them for single-binded meshes later
-        matrix = boneTransforms[bone.id] = getWorldTransform(bone)
-        eb = skeleton.edit_bones.new(f'bone_{bone.id}')
-        eb.matrix = matrix.transposed()
-        eb.use_connect = True
-
-        # Inherit rotation/scale and use deform
-        # eb.use_inherit_scale = eb.use_inherit_rotation = eb.use_deform = True
-
-        # Assign parent bone
-        if bone.parentId != -1:
-            eb.parent = skeleton.edit_bones[bone.parentId]
-            eb.tail = (boneTransforms[bone.parentId] @ Vector(bone.translation)).to_3d()
-            boneTransforms[bone.id] = boneTransforms[bone.parentId] @ boneTransforms[bone.id]
 
-        eb.tail[1] += 0.001  # Blender will delete all zero-length bones
+    # Bone matrices are worked out now, but the edit bones are only created once
+    # per import (see buildSkeletons) so we don't switch modes for every model
+    boneTransforms, editBones = getBoneTransforms(cmb.skeleton)
 
-        #print(f"bone: {bone.id}, parent: {bone.parentId}, position: {bone.translation}, rotation: {bone.rotation}, scale: {bone.scale}")
+    if isProxy:
+        skl_obj["cmb_proxy"] = True
+        loadProxyMeshes(f, cmb, contentHash, skl_obj, boneTransforms, collection, session)
+        skl_obj.parent = parent
+        return skl_obj
 
-    bpy.ops.object.mode_set(mode='OBJECT')
-    bpy.ops.object.select_all(action='DESELECT')
+    session.pendingSkeletons.append((skl_obj, editBones))
 
     # ################################################################
     # Add Textures
     # ################################################################
-    textureNames = []  # Used as a lookup
+    textureImages = []  # Used as a lookup
 
     if (not os.path.exists(folderName)):
         os.mkdir(folderName)
 
     for t in cmb.textures:
-        f.seek(cmb.texDataOfs + t.dataOffset)
         fileName = os.path.join(folderName, t.name) + ".png"
-        textureNames.append(fileName)
 
-        # Note: Pixels are in floating-point values
         if (cmb.texDataOfs != 0):
-            image = bpy.data.images.new(t.name, t.width, t.height, alpha=True)
-            pixels = DecodeBuffer(readArray(f, t.dataLength, DataTypes.UByte),
-                                    t.width, t.height, t.imageFormat, t.isETC1)
-            image.pixels = pixels
-            image.update()  # Updates the display image                
-            image.filepath_raw = fileName
-            image.file_format = 'PNG'
-            image.save()
-            # Pack the image into the .blend file. True = pack as .png
-            # packed_data = struct.pack('f' * len(pixels), *pixels)
-            # image.pack(data=packed_data, data_len=len(packed_data))
+            f.seek(cmb.texDataOfs + t.dataOffset)
+            textureImages.append(decodeImage(session, t.name, fileName, f.read(t.dataLength),
+                                             t.width, t.height, t.imageFormat, t.isETC1))
+        else:
+            # Stored separately, e.g. a .ctxb in the same archive
+            image = findImage(session, fileName)
+            if image is None and session.catalog is not None:
+                image = findCatalogImage(session, t.name, folderName, fileName)
+            textureImages.append(image)
 
     # ################################################################
     # Add Materials
@@ -98,7 +100,9 @@ def loadCmb(f: io.BufferedReader, folderName, collection, parent):
     materialNames = []  # Used as a lookup
 
     for matIdx in range(len(cmb.materials)):
-        generateMaterial(cmb.materials[matIdx], cmb.name, materialNames, textureNames)
+        with profiling.stage("generateMaterial"):
+            generateMaterial(cmb.materials[matIdx], cmb.name, materialNames, textureImages, session.materials,
+                             session.bakeCombiners, session.deferMaterials)
 
     # ################################################################
     # Build Meshes
@@ -107,283 +111,382 @@ def loadCmb(f: io.BufferedReader, folderName, collection, parent):
     for m in range(len(cmb.meshes)):
         mesh = cmb.meshes[m]
         shape = cmb.shapes[mesh.shapeIndex]
-        indices = [faces for pset in shape.primitiveSets for faces in pset.primitive.indices]
-        vertexCount = max(indices)+1
-        vertices = []
-        bindices = {}
 
         #print(f"mesh: {m}, shape: {mesh.shapeIndex}, bone: {mesh.ID}, material: {mesh.materialIndex}")
 
-        # Python doesn't have increment operator (afaik) so this must be ugly...
-        inc = 0  # increment
-        hasNrm = getFlag(shape.vertFlags, 1, inc)
-        if cmb.version > 6:
-            inc += 1  # Skip "HasTangents" for now
-        hasClr = getFlag(shape.vertFlags, 2, inc)
-        hasUv0 = getFlag(shape.vertFlags, 3, inc)
-        hasUv1 = getFlag(shape.vertFlags, 4, inc)
-        hasUv2 = getFlag(shape.vertFlags, 5, inc)
-        hasBi = getFlag(shape.vertFlags, 6, inc)
-        hasBw = getFlag(shape.vertFlags, 7, inc)
-
-        # Create new mesh
-        # ID is used for visibility animations
-        nmesh = bpy.data.meshes.new('shape_{}'.format(mesh.shapeIndex))
-        nmesh.use_auto_smooth = True  # Needed for custom split normals
-        nmesh.materials.append(bpy.data.materials.get(materialNames[mesh.materialIndex]))  # Add material to mesh
+        # Shapes rigged to one bone are placed by the object's transform
+        isRigid = shape.primSetCount == 1 and shape.primitiveSets[0].skinningMode != SkinningMode.Smooth and shape.primitiveSets[0].boneTableCount == 1
+
+        # Meshes using the same shape of the same model (even from another file) share their mesh data
+        meshKey = (contentHash, mesh.shapeIndex, isRigid)
+        nmesh = session.meshes.get(meshKey)
+        isNewMesh = nmesh is None
+        if isNewMesh:
+            with profiling.stage("bmesh") as stage:
+                nmesh = session.meshes[meshKey] = buildShapeMesh(f, cmb, mesh.shapeIndex, boneTransforms, session.useCustomNormals)
+                stage.count(items=len(nmesh.vertices))
 
+        # ID is used for visibility animations
         obj = bpy.data.objects.new('mesh_{}'.format(m), nmesh)  # Create new mesh object
         obj.parent = skl_obj  # Set parent skeleton
         collection.objects.link(obj)
         # obj.parent_type = 'BONE'
         # obj.parent_bone = 'bone_{}'.format(mesh.ID)
 
+        # Link the material to the object so shared mesh data can still use a different material
+        obj.material_slots[0].link = 'OBJECT'
+        obj.material_slots[0].material = bpy.data.materials.get(materialNames[mesh.materialIndex])
+
         ArmMod = obj.modifiers.new(skl_obj.name, "ARMATURE")
         ArmMod.object = skl_obj  # Set the modifiers armature
 
-        for bone in bpy.data.armatures[skeleton.name].bones.values():
-            obj.vertex_groups.new(name=bone.name)
-
-        # Get bone indices. We need to get these first because-
-        # each primitive has it's own bone table
-        for s in shape.primitiveSets:
-            for i in s.primitive.indices:
-                if (hasBi and s.skinningMode != SkinningMode.Single):
-                    f.seek(cmb.vatrOfs + vb.bIndices.startOfs +
-                            shape.bIndices.start + i * shape.boneDimensions)
-                    for bi in range(shape.boneDimensions):
-                        index = int(readDataType(f, shape.bIndices.dataType) * shape.bIndices.scale)
-                        bindices[i * shape.boneDimensions + bi] = (s.boneTable[index], s.skinningMode)
-                else:
-                    # For single-bind meshes
-                    bindices[i] = (s.boneTable[0], s.skinningMode)
-
-        if shape.primSetCount == 1 and shape.primitiveSets[0].skinningMode != SkinningMode.Smooth and shape.primitiveSets[0].boneTableCount == 1:
+        for bone in cmb.skeleton:
+            obj.vertex_groups.new(name=f'bone_{bone.id}')
+
+        if isRigid:
             obj.matrix_world = boneTransforms[shape.primitiveSets[0].boneTable[0]]
 
-        # Create new bmesh
-        bm = bmesh.new()
-        bm.from_mesh(nmesh)
-        weight_layer = bm.verts.layers.deform.new()  # Add new deform layer
+        if isNewMesh and session.analyseUvWraps and len(nmesh.uv_layers) > 0:
+            printUvWraps(cmb, mesh, obj, nmesh, textureImages)
 
-        # TODO: Support constants
-        # Get vertices
-        for i in range(vertexCount):
-            v = Vertex()  # Ugly because I don't care :)
+    skl_obj.parent = parent
 
-            # Position
-            bmv = bm.verts.new(readVector(f, cmb, i, vb.position, shape.position, 3, 3))
-            if (bindices[i][1] != SkinningMode.Smooth):
-                bmv.co = transformPosition(bmv.co, boneTransforms[bindices[i][0]])
+    if ownsSession:
+        buildSkeletons(session)
+    return skl_obj
 
-            # Normal
-            if hasNrm:
-                v.nrm = readVector(f, cmb, i, vb.normal, shape.normal, 3, 3)
+def loadProxyMeshes(f, cmb: Cmb, contentHash: str, skl_obj, boneTransforms: dict, collection, session: ImportSession):
+    # Geometry only, in model space, so there are no bones, textures or materials to create
+    from .proxy import buildProxyMesh
 
-                if (bindices[i][1] != SkinningMode.Smooth):
-                    v.nrm = transformNormal(v.nrm, boneTransforms[bindices[i][0]])
+    for m, mesh in enumerate(cmb.meshes):
+        meshKey = (contentHash, mesh.shapeIndex, session.proxyMode)
+        nmesh = session.meshes.get(meshKey)
+        if nmesh is None:
+            nmesh = session.meshes[meshKey] = buildProxyMesh(f, cmb, mesh.shapeIndex, boneTransforms, session.proxyMode)
 
-            # Color
-            if hasClr:
-                elements = 3 if bpy.app.version < (2, 80, 0) else 4
-                v.clr = readVector(f, cmb, i, vb.color, shape.color, 4, elements)
+        obj = bpy.data.objects.new(f'proxy_{m}', nmesh)
+        obj.parent = skl_obj
+        obj["cmb_proxy"] = True
+        collection.objects.link(obj)
 
-            # UV0
-            if hasUv0:
-                v.uv0 = readVector(f, cmb, i, vb.uv0, shape.uv0, 2, 2)
+def getBoneTransforms(bones: list) -> tuple[dict, list]:
+    boneTransforms = {}
+    editBones = []  # (name, parent name, matrix, tail) in the order they must be created
+    bonesById = {bone.id: bone for bone in bones}
 
-            # UV1
-            if hasUv1:
-                v.uv1 = readVector(f, cmb, i, vb.uv1, shape.uv1, 2, 2)
+    for bone in sortBones(bones):
+        # Save the matrices so we don't have to recalculate them for single-binded meshes later
+        matrix = boneTransforms[bone.id] = getWorldTransform(bone)
+        parentName = None
+        tail = None
 
-            # UV2
-            if hasUv2:
-                v.uv2 = readVector(f, cmb, i, vb.uv2, shape.uv2, 2, 2)
-
-            # Bone Weights
-            if hasBw:
-                # For smooth meshes
-                f.seek(cmb.vatrOfs + vb.bWeights.startOfs + shape.bWeights.start + i * shape.boneDimensions)
-                for j in range(shape.boneDimensions):
-                    weight = round(readDataType(f, shape.bWeights.dataType) * shape.bWeights.scale, 2)
-                    if (weight > 0):
-                        bmv[weight_layer][bindices[i * shape.boneDimensions + j][0]] = weight
+        if bone.parentId in bonesById:
+            parentName = f'bone_{bone.parentId}'
+            tail = (boneTransforms[bone.parentId] @ Vector(bone.translation)).to_3d()
+            boneTransforms[bone.id] = boneTransforms[bone.parentId] @ matrix
+
+        editBones.append((f'bone_{bone.id}', parentName, matrix.transposed(), tail))
+
+        #print(f"bone: {bone.id}, parent: {bone.parentId}, position: {bone.translation}, rotation: {bone.rotation}, scale: {bone.scale}")
+
+    return boneTransforms, editBones
+
+def sortBones(bones: list) -> list:
+    # Parents always come before their children
+    bonesById = {bone.id: bone for bone in bones}
+    visited = set()
+    ordered = []
+
+    for bone in bones:
+        chain = []
+        while bone is not None and bone.id not in visited:
+            visited.add(bone.id)
+            chain.append(bone)
+            bone = bonesById.get(bone.parentId)
+        ordered.extend(reversed(chain))
+
+    return ordered
+
+def buildSkeletons(session: ImportSession):
+    if len(session.pendingSkeletons) == 0:
+        return
+
+    # Every armature of the import is edited in one multi-object edit mode session
+    view_layer = bpy.context.view_layer
+    for obj in view_layer.objects.selected:
+        obj.select_set(False)
+    for skl_obj, _ in session.pendingSkeletons:
+        skl_obj.select_set(True)
+    view_layer.objects.active = session.pendingSkeletons[0][0]
+    bpy.ops.object.mode_set(mode='EDIT')
+
+    for skl_obj, editBones in session.pendingSkeletons:
+        skeleton = skl_obj.data
+        for name, parentName, matrix, tail in editBones:
+            eb = skeleton.edit_bones.new(name)
+            eb.matrix = matrix
+            eb.use_connect = True
+
+            # Inherit rotation/scale and use deform
+            # eb.use_inherit_scale = eb.use_inherit_rotation = eb.use_deform = True
+
+            # Assign parent bone
+            if parentName is not None:
+                eb.parent = skeleton.edit_bones[parentName]
+                eb.tail = tail
+
+            eb.tail[1] += 0.001  # Blender will delete all zero-length bones
+
+    bpy.ops.object.mode_set(mode='OBJECT')
+    for skl_obj, _ in session.pendingSkeletons:
+        skl_obj.select_set(False)
+    session.pendingSkeletons.clear()
+
+def buildShapeMesh(f: io.BufferedReader, cmb: Cmb, shapeIndex: int, boneTransforms: dict, useCustomNormals: bool = True):
+    vb = cmb.vatr  # VertexBufferInfo
+    shape = cmb.shapes[shapeIndex]
+    indices = [faces for pset in shape.primitiveSets for faces in pset.primitive.indices]
+    # Shapes share the Vatr buffers, so only decode the rows this shape actually references
+    usedIndices = sorted(set(indices))
+    remap = {old: new for new, old in enumerate(usedIndices)}
+    bindices = {}
+
+    # Python doesn't have increment operator (afaik) so this must be ugly...
+    inc = 0  # increment
+    hasNrm = getFlag(shape.vertFlags, 1, inc)
+    if cmb.version > 6:
+        inc += 1  # Skip "HasTangents" for now
+    hasClr = getFlag(shape.vertFlags, 2, inc)
+    hasUv0 = getFlag(shape.vertFlags, 3, inc)
+    hasUv1 = getFlag(shape.vertFlags, 4, inc)
+    hasUv2 = getFlag(shape.vertFlags, 5, inc)
+    hasBi = getFlag(shape.vertFlags, 6, inc)
+    hasBw = getFlag(shape.vertFlags, 7, inc)
+
+    # Create new mesh
+    nmesh = bpy.data.meshes.new('shape_{}'.format(shapeIndex))
+    nmesh.materials.append(None)  # Material slot, filled in per object
+
+    # Get bone indices. We need to get these first because-
+    # each primitive has it's own bone table
+    for s in shape.primitiveSets:
+        for i in s.primitive.indices:
+            if (hasBi and s.skinningMode != SkinningMode.Single):
+                f.seek(cmb.vatrOfs + vb.bIndices.startOfs +
+                        shape.bIndices.start + i * shape.boneDimensions)
+                for bi in range(shape.boneDimensions):
+                    index = int(readDataType(f, shape.bIndices.dataType) * shape.bIndices.scale)
+                    bindices[i * shape.boneDimensions + bi] = (s.boneTable[index], s.skinningMode)
             else:
                 # For single-bind meshes
-                bmv[weight_layer][bindices[i][0]] = 1.0
+                bindices[i] = (s.boneTable[0], s.skinningMode)
+
+    # Create new bmesh
+    bm = bmesh.new()
+    bm.from_mesh(nmesh)
+    weight_layer = bm.verts.layers.deform.new()  # Add new deform layer
+
+    # TODO: Support constants
+    # Decode each attribute for all used vertices at once
+    positions = readAttributeArray(f, cmb, vb.position, shape.position, usedIndices, 3, 3).tolist()
+    normals = readAttributeArray(f, cmb, vb.normal, shape.normal, usedIndices, 3, 3) if hasNrm else None
+    elements = 3 if bpy.app.version < (2, 80, 0) else 4
+    colours = readAttributeArray(f, cmb, vb.color, shape.color, usedIndices, 4, elements).tolist() if hasClr else None
+    uvs0 = readAttributeArray(f, cmb, vb.uv0, shape.uv0, usedIndices, 2, 2).tolist() if hasUv0 else None
+    uvs1 = readAttributeArray(f, cmb, vb.uv1, shape.uv1, usedIndices, 2, 2).tolist() if hasUv1 else None
+    uvs2 = readAttributeArray(f, cmb, vb.uv2, shape.uv2, usedIndices, 2, 2).tolist() if hasUv2 else None
+    rigidBones = {}  # Bone ID -> vertices baked into that bone's space
+
+    # Get vertices
+    for n, i in enumerate(usedIndices):
+        # Position
+        bmv = bm.verts.new(positions[n])
+        if (bindices[i][1] != SkinningMode.Smooth):
+            bmv.co = transformPosition(bmv.co, boneTransforms[bindices[i][0]])
+            rigidBones.setdefault(bindices[i][0], []).append(n)
+
+        # Bone Weights
+        if hasBw:
+            # For smooth meshes
+            f.seek(cmb.vatrOfs + vb.bWeights.startOfs + shape.bWeights.start + i * shape.boneDimensions)
+            for j in range(shape.boneDimensions):
+                weight = round(readDataType(f, shape.bWeights.dataType) * shape.bWeights.scale, 2)
+                if (weight > 0):
+                    bmv[weight_layer][bindices[i * shape.boneDimensions + j][0]] = weight
+        else:
+            # For single-bind meshes
+            bmv[weight_layer][bindices[i][0]] = 1.0
+
+    # Normal
+    if hasNrm:
+        for boneId, rows in rigidBones.items():
+            invMat = boneTransforms[boneId].inverted()
+            normals[rows] = normals[rows] @ np.array([invMat[r].xyz for r in range(3)], dtype=np.float32).T
+
+    # Must always be called after adding/removing vertices or accessing them by index
+    bm.verts.ensure_lookup_table()
+    bm.verts.index_update()  # Assign an index value to each vertex
+
+    for i in range(0, len(indices), 3):
+        try:
+            face = bm.faces.new(bm.verts[remap[j]] for j in indices[i:i + 3])
+            face.material_index = 0
+            face.smooth = True
+        except:  # face already exists
+            continue
+
+    uv_layer0 = bm.loops.layers.uv.new("UV0") if (hasUv0) else None
+    uv_layer1 = bm.loops.layers.uv.new("UV1") if (hasUv1) else None
+    uv_layer2 = bm.loops.layers.uv.new("UV2") if (hasUv2) else None
+    col_layer = bm.loops.layers.color.new("Colour") if (hasClr) else None
+
+    for face in bm.faces:
+        for loop in face.loops:
+            if hasUv0:
+                loop[uv_layer0].uv = uvs0[loop.vert.index]
+            if hasUv1:
+                loop[uv_layer1].uv = uvs1[loop.vert.index]
+            if hasUv2:
+                loop[uv_layer2].uv = uvs2[loop.vert.index]
+            if hasClr:
+                loop[col_layer] = colours[loop.vert.index]
 
-            vertices.append(v)
+    # Assign bmesh to newly created mesh
+    nmesh.update()
+    bm.to_mesh(nmesh)
 
-        # Must always be called after adding/removing vertices or accessing them by index
-        bm.verts.ensure_lookup_table()
-        bm.verts.index_update()  # Assign an index value to each vertex
+    bm.free()  # Remove all the mesh data immediately and disable further access
 
-        for i in range(0, len(indices), 3):
-            try:
-                face = bm.faces.new(bm.verts[j] for j in indices[i:i + 3])
-                face.material_index = mesh.materialIndex
-                face.smooth = True
-            except:  # face already exists
-                continue
-
-        uv_layer0 = bm.loops.layers.uv.new("UV0") if (hasUv0) else None
-        uv_layer1 = bm.loops.layers.uv.new("UV1") if (hasUv1) else None
-        uv_layer2 = bm.loops.layers.uv.new("UV2") if (hasUv2) else None
-        col_layer = bm.loops.layers.color.new("Colour") if (hasClr) else None
-
-        for face in bm.faces:
-            for loop in face.loops:
-                if hasUv0:
-                    uv0 = vertices[loop.vert.index].uv0
-                    loop[uv_layer0].uv = (uv0[0], uv0[1])
-                if hasUv1:
-                    uv1 = vertices[loop.vert.index].uv1
-                    loop[uv_layer1].uv = (uv1[0], uv1[1])
-                if hasUv2:
-                    uv2 = vertices[loop.vert.index].uv2
-                    loop[uv_layer2].uv = (uv2[0], uv2[1])
-                if hasClr:
-                    loop[col_layer] = vertices[loop.vert.index].clr
-
-        # Assign bmesh to newly created mesh
-        nmesh.update()
-        bm.to_mesh(nmesh)
-
-        if hasUv0 or hasUv1 or hasUv2:
-
-            for uv_layer in obj.data.uv_layers:
-                # Set the active UV map
-                obj.data.uv_layers.active = uv_layer
-
-                # Get linked UV islands
-                islands = find_uv_islands(nmesh)
-
-                wraps = False
-
-                # Iterate over UV islands
-                for i, island in enumerate(islands):
-                    min_u, max_u = math.inf, -math.inf
-                    min_v, max_v = math.inf, -math.inf
-
-                    # Iterate over UV coordinates in the island
-                    for loop_index in island:
-                        uv_coords = uv_layer.data[loop_index].uv
-                        min_u = min(min_u, uv_coords[0])
-                        max_u = max(max_u, uv_coords[0])
-                        min_v = min(min_v, uv_coords[1])
-                        max_v = max(max_v, uv_coords[1])
-
-                    delta_u = max_u - min_u
-                    delta_v = max_v - min_v
-
-                    wraps_u = delta_u > 1 or math.ceil(min_u) == math.floor(max_u) and min_u % 1 != 0 and max_u % 1 != 0
-                    wraps_v = delta_v > 1 or math.ceil(min_v) == math.floor(max_v) and min_v % 1 != 0 and max_v % 1 != 0
-                    
-                    if (not (wraps_u or wraps_v)):
-                        continue
-                
-                    if not wraps:
-                        texture = cmb.materials[mesh.materialIndex].TextureMappers[1]
-                        print(f"Model: {cmb.name}, Mesh: {obj.name}, Texure: {os.path.basename(textureNames[texture.textureID])}, WrapS: {texture.wrapS.name}, WrapT: {texture.wrapT.name}")
-                        wraps = True
-
-                    text = f"Island: {i}, Vertices: {len(island)}"
-
-                    # Check if UVs in the island cross the repeat boundary
-                    if wraps_u:
-                        text += f", U: {min_u:6.3f} <-> {max_u:6.3f} ({delta_u:.3f})"
-
-                    if wraps_v:
-                        text += f", V: {min_v:6.3f} <-> {max_v:6.3f} ({delta_v:.3f})"
-
-                    print(text)
-
-        bm.free()  # Remove all the mesh data immediately and disable further access
-
-        # Blender has no idea what normals are
-        # TODO: Add an option
-        UseCustomNormals = True
-        if (UseCustomNormals and hasNrm):
-            nmesh.normals_split_custom_set_from_vertices([vertices[i].nrm for i in range(len(vertices))])
+    # Blender has no idea what normals are
+    if useCustomNormals:
+        nmesh.use_auto_smooth = True  # Needed for custom split normals
+        if hasNrm:
+            nmesh.normals_split_custom_set_from_vertices(normals)
         else:
-            clnors = array.array('f', [0.0] * (len(nmesh.loops) * 3))
+            clnors = np.empty(len(nmesh.loops) * 3, dtype=np.float32)
             nmesh.loops.foreach_get("normal", clnors)
-            nmesh.normals_split_custom_set(tuple(zip(*(iter(clnors),) * 3)))
-
-    skl_obj.parent = parent
-    return skl_obj
+            nmesh.normals_split_custom_set(clnors.reshape(-1, 3))
+
+    return nmesh
+
+NumpyDataTypes = {
+    DataTypes.Byte: '<i1',
+    DataTypes.UByte: '<u1',
+    DataTypes.Short: '<i2',
+    DataTypes.UShort: '<u2',
+    DataTypes.Int: '<i4',
+    DataTypes.UInt: '<u4',
+    DataTypes.Float: '<f4',
+}
+
+def readAttributeArray(f: BufferedReader, cmb: Cmb, vb: AttributeSlice, shape: VertexAttribute, indices: list, size: int, sizeBlender: int) -> np.ndarray:
+    # Returns a float32 (len(indices), sizeBlender) array of the scaled attribute rows
+    dtype = np.dtype(NumpyDataTypes.get(shape.dataType, '<f4'))
+    rows = np.asarray(indices, dtype=np.int64)
+    first = int(rows.min())
+    count = int(rows.max()) - first + 1
+
+    f.seek(cmb.vatrOfs + vb.startOfs + shape.start + size * dtype.itemsize * first)
+    data = np.frombuffer(f.read(count * size * dtype.itemsize), dtype=dtype).reshape(count, size)
+    return data[rows - first, :sizeBlender].astype(np.float32) * np.float32(shape.scale)
+
+def printUvWraps(cmb: Cmb, mesh: Mesh, obj, nmesh, textureImages: list):
+    for uv_layer in nmesh.uv_layers:
+        wraps = False
+
+        # Get linked UV islands
+        with profiling.stage("find_uv_islands") as stage:
+            islands = find_uv_islands(nmesh, uv_layer)
+            stage.count(items=len(islands))
+        for i, island in enumerate(islands):
+            min_u, min_v = island.minUV
+            max_u, max_v = island.maxUV
+
+            delta_u = max_u - min_u
+            delta_v = max_v - min_v
+
+            wraps_u = delta_u > 1 or math.ceil(min_u) == math.floor(max_u) and min_u % 1 != 0 and max_u % 1 != 0
+            wraps_v = delta_v > 1 or math.ceil(min_v) == math.floor(max_v) and min_v % 1 != 0 and max_v % 1 != 0
+
+            if (not (wraps_u or wraps_v)):
+                continue
 
-def readVector(f: BufferedReader, cmb: Cmb, i, vb: AttributeSlice, shape: VertexAttribute, size: int, sizeBlender: int):
-    f.seek(cmb.vatrOfs + vb.startOfs + shape.start + size * getDataTypeSize(shape.dataType) * i)
-    return [e * shape.scale for e in readArray(f, sizeBlender, shape.dataType)]
-
-def find_uv_islands(mesh):
-    loop_to_uv = mesh.uv_layers.active.data
-
-    # Create a lookup of loop index to polygons
-    uv_to_polygons = {}
-    for i, poly in enumerate(mesh.polygons):
-        for loop_index in poly.loop_indices:
-            uv_coord = tuple(loop_to_uv[loop_index].uv)
-            if uv_coord not in uv_to_polygons:
-                uv_to_polygons[uv_coord] = set()
-            uv_to_polygons[uv_coord].add(i)
-
-    # Create a lookup of each polygon's status (0: not used, 1: used)
-    polygon_status = {i: 0 for i in range(len(mesh.polygons))}
-
-    # Create a list of islands
-    islands = []
-
-    def traverse_island(start_polygon_index, island_set):
-        stack = [start_polygon_index]
-        
-        while stack:
-            polygon_index = stack.pop()
-
-            # Add loop uv indices to the island set
-            island_set.update(mesh.polygons[polygon_index].loop_indices)
-
-            poly_uvs = set(tuple(loop_to_uv[loop_index].uv) for loop_index in mesh.polygons[polygon_index].loop_indices)
-            # Iterate over the polygon loop indices
-            for loop_index in mesh.polygons[polygon_index].loop_indices:
-                # Get linked polygons using the lookup
-                linked_polygons = uv_to_polygons.get(tuple(loop_to_uv[loop_index].uv), set())
-
-                # Iterate over linked polygons
-                for linked_polygon_index in linked_polygons:
-                    linked_poly_uvs = set(tuple(loop_to_uv[linked_loop_index].uv) for linked_loop_index in mesh.polygons[linked_polygon_index].loop_indices)
-                    # If the polygon hasn't been used and has two shared loop indices with the previous polygon
-                    if (polygon_index != linked_polygon_index
-                        and polygon_status[linked_polygon_index] == 0
-                        and len(poly_uvs.intersection(linked_poly_uvs)) >= 2):
-                        # Mark the polygon as used
-                        polygon_status[linked_polygon_index] = 1
-                        stack.append(linked_polygon_index)
-
-    # Iterate over polygons
-    for polygon_index in range(len(mesh.polygons)):
-        # If the polygon isn't used
-        if polygon_status[polygon_index] == 0:
-            # Create a set of loop uv indices containing the first polygon indices
-            current_island = set()
-
-            # Mark the polygon as used
-            polygon_status[polygon_index] = 1
-
-            # Start traversing the island
-            traverse_island(polygon_index, current_island)
-
-            # Add the island set to the list of islands
-            islands.append(current_island)
-
-    return islands
-
-class Vertex(object):
-    def __init__(self):
-        self.pos = []
-        self.nrm = []
-        self.clr = []
-        self.uv0 = []
-        self.uv1 = []
-        self.uv2 = []
\ No newline at end of file
+            if not wraps:
+                texture = cmb.materials[mesh.materialIndex].TextureMappers[1]
+                print(f"Model: {cmb.name}, Mesh: {obj.name}, Texure: {getattr(textureImages[texture.textureID], 'name', None)}, WrapS: {texture.wrapS.name}, WrapT: {texture.wrapT.name}")
+                wraps = True
+
+            text = f"Island: {i}, Vertices: {island.loopCount}"
+
+            # Check if UVs in the island cross the repeat boundary
+            if wraps_u:
+                text += f", U: {min_u:6.3f} <-> {max_u:6.3f} ({delta_u:.3f})"
+
+            if wraps_v:
+                text += f", V: {min_v:6.3f} <-> {max_v:6.3f} ({delta_v:.3f})"
+
+            print(text)
+
+def find_uv_islands(mesh, uv_layer) -> list:
+    loopCount = len(mesh.loops)
+    polyCount = len(mesh.polygons)
+    if polyCount == 0:
+        return []
+
+    uvs = np.empty(loopCount * 2, dtype=np.float32)
+    uv_layer.data.foreach_get("uv", uvs)
+    uvs = uvs.reshape(-1, 2)
+    loopStart = np.empty(polyCount, dtype=np.int64)
+    loopTotal = np.empty(polyCount, dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", loopStart)
+    mesh.polygons.foreach_get("loop_total", loopTotal)
+
+    # Loops are stored contiguously per polygon, so each loop's edge runs to the next loop (wrapping per polygon)
+    loopPoly = np.repeat(np.arange(polyCount), loopTotal)
+    nextLoop = np.arange(1, loopCount + 1)
+    nextLoop[loopStart + loopTotal - 1] = loopStart
+
+    # Loops with identical UV coordinates share a key, and polygons sharing a UV edge are in the same island
+    uvKeys = np.unique(uvs, axis=0, return_inverse=True)[1].reshape(-1)
+    edges = np.sort(np.stack((uvKeys, uvKeys[nextLoop]), axis=1), axis=1)
+    valid = edges[:, 0] != edges[:, 1]
+    edges, edgePoly = edges[valid], loopPoly[valid]
+    edgeKeys = np.unique(edges, axis=0, return_inverse=True)[1].reshape(-1)
+    firstPoly = np.full(len(edges), polyCount, dtype=np.int64)
+    np.minimum.at(firstPoly, edgeKeys, edgePoly)
+    linkedPoly = firstPoly[edgeKeys]
+    linked = edgePoly != linkedPoly
+
+    parents = list(range(polyCount))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for a, b in zip(edgePoly[linked].tolist(), linkedPoly[linked].tolist()):
+        rootA, rootB = find(a), find(b)
+        if rootA != rootB:
+            parents[max(rootA, rootB)] = min(rootA, rootB)
+
+    # Roots are always the lowest polygon index, so islands come out in the order they're first seen
+    roots = np.array([find(i) for i in range(polyCount)], dtype=np.int64)
+    islandRoots, polyIsland = np.unique(roots, return_inverse=True)
+    islandCount = len(islandRoots)
+    loopIsland = polyIsland.reshape(-1)[loopPoly]
+
+    minUV = np.full((islandCount, 2), np.inf, dtype=np.float32)
+    maxUV = np.full((islandCount, 2), -np.inf, dtype=np.float32)
+    np.minimum.at(minUV, loopIsland, uvs)
+    np.maximum.at(maxUV, loopIsland, uvs)
+    loopCounts = np.bincount(loopIsland, minlength=islandCount)
+
+    return [UVIsland(int(loopCounts[i]), minUV[i].tolist(), maxUV[i].tolist()) for i in range(islandCount)]
+
+class UVIsland(object):
+    def __init__(self, loopCount: int, minUV: list, maxUV: list):
+        self.loopCount = loopCount
+        self.minUV = minUV
+        self.maxUV = maxUV
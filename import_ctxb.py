@@ -0,0 +1,109 @@
+import io, os, bpy
+import numpy as np
+
+from io import BufferedReader
+from .utils import *
+from .ctxb import CTXB, getImageKey, isETC1Format
+from .cmbEnums import GLTextureFormat
+from .ctrTexture import DecodeBuffer
+from .session import ImportSession
+from . import profiling
+
+def findImage(session: ImportSession, imagePath: str):
+    # Textures that aren't embedded are looked up by the path they were (or will be) saved to
+    imagePath = session.imagePathAliases.get(imagePath, imagePath)
+    image = session.imagesByPath.get(imagePath)
+    if image is None and os.path.exists(imagePath):
+        image = session.imagesByPath[imagePath] = bpy.data.images.load(imagePath, check_existing=True)
+    return image
+
+def getFreeImagePath(session: ImportSession, imagePath: str, key: str) -> str:
+    # Textures with the same name but different content (e.g. from different archives) can be
+    # saved to the same folder, the later ones get the start of their hash added to the name
+    if imagePath not in session.imagesByPath or session.imageKeysByPath.get(imagePath) == key:
+        return imagePath
+    stem, ext = os.path.splitext(imagePath)
+    return f"{stem}_{key[:8]}{ext}"
+
+def decodeImage(session: ImportSession, name: str, imagePath: str, data: bytes, width: int, height: int, format: GLTextureFormat, isETC1: bool):
+    # Each texture is decoded at most once per import, however many files embed it
+    key = getImageKey(data, width, height, format)
+    image = session.imagesByHash.get(key)
+
+    if image is None:
+        imagePath = getFreeImagePath(session, imagePath, key)
+        # Note: Pixels are in floating-point values
+        image = bpy.data.images.new(name, width, height, alpha=True)
+        pixels = session.decodedPixels.pop(key, None)  # Decoded ahead of time by prefetch.iterPrefetch
+        if pixels is None:
+            with profiling.stage("DecodeBuffer", bytes=len(data), items=width * height):
+                pixels = np.array(DecodeBuffer(data, width, height, format, isETC1), dtype=np.float32)
+        image.pixels.foreach_set(pixels)
+        image.update()  # Updates the display image
+        image.filepath_raw = imagePath
+        image.file_format = 'PNG'
+        with profiling.stage("image.save", items=width * height):
+            image.save()
+
+    session.imagesByHash[key] = image
+    # By path too, so materials looking next to their model find it (a copy found by hash only if the path is free)
+    if imagePath not in session.imagesByPath:
+        session.imagesByPath[imagePath] = image
+        session.imageKeysByPath[imagePath] = key
+    return image
+
+def loadCtxb(file: BufferedReader, folderName: str, fileName: str, session: ImportSession = None) -> list[str]:
+    return runSteps(iterCtxb(file, folderName, fileName, session))
+
+def iterCtxb(file: BufferedReader, folderName: str, fileName: str, session: ImportSession = None):
+    # Returns the paths of the file's images, whether they were decoded now or already existed
+    session = session or ImportSession()
+    imagePaths = []
+    try:
+        ctxb = CTXB(file)
+        textures = [t for chunk in ctxb.Chunks for t in chunk.Textures]
+
+        for i, t in enumerate(textures):
+            name = t.Name if t.Name != "" else os.path.splitext(fileName)[0]
+            format = t.TextureFormat
+            imagePath = os.path.join(folderName, f"{name}.png")
+            if imagePath not in session.imagesByPath and os.path.exists(imagePath):
+                imagePaths.append(imagePath)
+                continue  # Saved by an earlier import, findImage picks it up when a material needs it
+
+            image = decodeImage(session, t.Name, imagePath, t.Data, t.Width, t.Height, format, isETC1Format(format))
+            imagePaths.append(imagePath if session.imagesByPath.get(imagePath) is image else image.filepath_raw)
+            yield (i + 1) / len(textures)
+
+    except Exception as ex:
+        print("Failed to load CTXB file")
+        print(ex)
+
+    return imagePaths
+
+def findCatalogImage(session: ImportSession, name: str, folderName: str, imagePath: str):
+    # Textures that aren't next to their model may still be somewhere else in the RomFS
+    location = session.catalog.findEntry(name, "ctxb")
+    if location is None:
+        return None
+
+    loadCtxb(session.catalog.openEntry(location), folderName, name, session)
+    return findImage(session, imagePath)
+
+def loadCtxbFiles(operator):
+    runSteps(iterCtxbFiles(operator))
+    return {"FINISHED"}
+
+def iterCtxbFiles(operator):
+    root = get_or_add_root()
+    session = ImportSession(operator)
+    profiling.start(session.profile)
+
+    dirname = os.path.dirname(operator.filepath)
+    try:
+        for i, file in enumerate(operator.files):
+            path = os.path.join(dirname, file.name)
+            with open(path, "rb") as f, profiling.file(path):
+                yield from scaleSteps(iterCtxb(f, os.path.dirname(path), file.name, session), i, len(operator.files))
+    finally:
+        profiling.finish(session.profileJson)
@@ -0,0 +1,114 @@
+import io, os, hashlib
+
+from io import BufferedReader
+from .utils import *
+from .gar import GAR
+from .import_ctxb import iterCtxb
+from .session import ImportSession
+from .catalog import getCatalog, findRomFSRoot
+from . import profiling
+
+def loadGar(garReader: BufferedReader, folderName, collection, parent, session: ImportSession = None):
+    return runSteps(iterGar(garReader, folderName, collection, parent, session))
+
+def iterGar(garReader: BufferedReader, folderName, collection, parent, session: ImportSession = None):
+    ownsSession = session is None
+    session = session or ImportSession()
+    gar = GAR(garReader)
+
+    firstModel = None
+    group = None
+    
+    files = list(reversed(gar.Files))
+    for i, file in enumerate(files):
+        payloadKey = None
+        if file.Ext == "ctxb" or file.Ext == "cmb":
+            # The same textures and models turn up in many archives, only the first copy is decoded
+            payloadKey = (file.Ext, hashlib.sha1(file.Data).hexdigest())
+            if payloadKey in session.payloads:
+                session.duplicateEntries += 1
+                session.duplicateBytes += file.Size
+
+        if file.Ext == "ctxb" and session.proxyMode == 'NONE':
+            if payloadKey in session.payloads:
+                # Materials look for textures next to their model, so point those paths at the first copy
+                for imagePath in session.payloads[payloadKey]:
+                    session.imagePathAliases.setdefault(os.path.join(folderName, os.path.basename(imagePath)), imagePath)
+            else:
+                if not os.path.exists(folderName):
+                    os.mkdir(folderName)
+
+                session.payloads[payloadKey] = yield from scaleSteps(iterCtxb(file.open(), folderName, file.FileName, session), i, len(files))
+
+        if file.Ext == "cmb":
+            # Still placed every time, but loadCmb reuses the parsed model and its meshes
+            session.payloads.setdefault(payloadKey, file.FileName)
+            from .import_cmb import loadCmbSafe
+            model = loadCmbSafe(file.open(), folderName, file.FileName, collection, parent, session, payloadKey[1])
+            if firstModel == None:
+                firstModel = model
+            else:
+                if group == None:
+                    group = bpy.data.objects.new(folderName.replace(os.path.dirname(folderName),"").strip(os.path.sep), None)
+                    collection.objects.link(group)
+                    group.parent = parent
+                    firstModel.parent = group
+                    if session.proxyMode != 'NONE':
+                        group["cmb_proxy"] = True
+                model.parent = group
+            yield (i + 1) / len(files)
+
+        if file.Ext == "gar":
+            childFolderName = os.path.join(folderName, file.FileName.replace("_tex", ""))
+            if not os.path.exists(folderName):
+                os.mkdir(folderName)
+            yield from scaleSteps(iterGar(file.open(), childFolderName, collection, parent, session), i, len(files))
+
+    if ownsSession:
+        from .import_cmb import buildSkeletons
+        buildSkeletons(session)
+        printDuplicates(session)
+
+    return firstModel if group == None else group
+
+def tagProxy(obj, modelPath: str, folderName: str, session: ImportSession):
+    # Lets gseb.replaceProxies load the full model in its place later on, with the import's options
+    obj["cmb_proxy_path"] = modelPath
+    obj["cmb_proxy_folder"] = folderName
+    obj["cmb_proxy_options"] = {
+        "use_custom_normals": session.useCustomNormals,
+        "bake_combiners": session.bakeCombiners,
+        "analyse_uv_wraps": session.analyseUvWraps,
+    }
+
+def printDuplicates(session: ImportSession):
+    if session.duplicateEntries > 0:
+        print(f"Reused {session.duplicateEntries} duplicate archive entries ({session.duplicateBytes / 1024:.1f} KiB)")
+    
+def loadGarFiles(operator):
+    runSteps(iterGarFiles(operator))
+    return {"FINISHED"}
+
+def iterGarFiles(operator):
+    root = get_or_add_root()
+    session = ImportSession(operator)
+    profiling.start(session.profile)
+    
+    dirname = os.path.dirname(operator.filepath)
+    try:
+        for i, file in enumerate(operator.files):
+            path = os.path.join(dirname, file.name)
+            
+            folderName = os.path.splitext(path)[0]
+            if not os.path.exists(folderName):
+                os.mkdir(folderName)
+            getCatalog(session, findRomFSRoot(path))
+            with profiling.file(path):
+                model = yield from scaleSteps(iterGar(openMapped(path), folderName, bpy.context.scene.collection, root, session), i, len(operator.files))
+            if model != None and session.proxyMode != 'NONE':
+                tagProxy(model, path, folderName, session)
+    finally:
+        from .import_cmb import buildSkeletons
+        buildSkeletons(session)
+        printDuplicates(session)
+        profiling.finish(session.profileJson)
\ No newline at end of file
@@ -1,9 +1,13 @@
-import bpy
+import bpy, hashlib, time
+import numpy as np
 
+from collections import deque
+from bpy.app.handlers import persistent
 from mathutils import Vector
 from typing import Tuple
 from bpy.types import ShaderNode, ShaderNodeInvert, ShaderNodeSeparateRGB, ShaderNodeRGB, NodeSocket
 from .cmb import *
+from .combinerBake import bakeCombiners, getSourceCount
 
 def getNodeFromSocket(socket: NodeSocket, type) -> ShaderNode:
     for link in socket.links:
@@ -29,37 +33,46 @@ def getSeparateRGBNode(nodes, links, source: NodeSocket) -> ShaderNode:
     links.new(source, separate.inputs['Image'])
     return separate
 
-def getSourceNode(m: Material, stage: Combiner, textures: list, constantColourNodes: list,
-                  previous: Tuple[NodeSocket, NodeSocket], previousBuffer: Tuple[NodeSocket, NodeSocket], diffuse: Tuple[NodeSocket, NodeSocket], vertexColour: Tuple[NodeSocket, NodeSocket],
-                  nodes: list, sourceType: TexCombinerSource) -> Tuple[NodeSocket, NodeSocket]:
-    match sourceType:
-        case TexCombinerSource.Texture0:
-            return (textures[0].outputs['Color'], textures[0].outputs['Alpha'])
-        case TexCombinerSource.Texture1:
-            return (textures[1].outputs['Color'], textures[1].outputs['Alpha'])
-        case TexCombinerSource.Texture2:
-            return (textures[2].outputs['Color'], textures[2].outputs['Alpha'])
-        case TexCombinerSource.Texture3:
-            return (textures[3].outputs['Color'], textures[3].outputs['Alpha'])
-        case TexCombinerSource.PrimaryColor:
-            return vertexColour
-        case TexCombinerSource.Constant:
-            colour = constantColourNodes[stage.constColorIndex]
-            return (colour[0].outputs['Color'], colour[1].outputs['Value'])
-        case TexCombinerSource.Previous:
-            return previous
-        case TexCombinerSource.PreviousBuffer:
-            return previousBuffer
-        case TexCombinerSource.FragmentPrimaryColor:
-            return diffuse
-        case TexCombinerSource.FragmentSecondaryColor:
-            colour = nodes.new("ShaderNodeRGB")
-            colour.label = "Fragment Secondary Colour"
-            colour.outputs['Color'].default_value = (0.0, 0.0, 0.0, 1.0)
-            alpha = nodes.new("ShaderNodeValue")
-            alpha.label = "Fragment Secondary Alpha"
-            alpha.outputs['Value'].default_value = 1.0
-            return (colour.outputs['Color'], alpha.outputs['Value'])
+def getImagePixels(image) -> np.ndarray:
+    pixels = np.empty(len(image.pixels), dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(image.size[1], image.size[0], -1)
+
+def getTextureNode(nodes, links, tm: TexMapper, tc: TexCoords, image) -> ShaderNode:
+    # Create new texture node
+    texture = nodes.new("ShaderNodeTexImage")
+    texture.image = image
+
+    texCoord = nodes.new("ShaderNodeUVMap")
+    texCoord.uv_map = f"UV{tc.uvChannel}"
+
+    if tm.wrapS == TextureWrapMode.Mirror or tm.wrapT == TextureWrapMode.Mirror:
+        separate = nodes.new('ShaderNodeSeparateXYZ')
+        combine = nodes.new('ShaderNodeCombineXYZ')
+        links.new(texCoord.outputs['UV'], separate.inputs['Vector'])
+        links.new(combine.outputs['Vector'], texture.inputs['Vector'])
+
+        if tm.wrapS == TextureWrapMode.Mirror:
+            pingpong = nodes.new('ShaderNodeMath')
+            pingpong.operation = 'PINGPONG'
+            pingpong.inputs[1].default_value = 1.0  # Scale
+            links.new(separate.outputs['X'], pingpong.inputs['Value'])
+            links.new(pingpong.outputs['Value'], combine.inputs['X'])
+        else:
+            links.new(separate.outputs['X'], combine.inputs['X'])
+
+        if tm.wrapT == TextureWrapMode.Mirror:
+            pingpong = nodes.new('ShaderNodeMath')
+            pingpong.operation = 'PINGPONG'
+            pingpong.inputs[1].default_value = 1.0  # Scale
+            links.new(separate.outputs['Y'], pingpong.inputs['Value'])
+            links.new(pingpong.outputs['Value'], combine.inputs['Y'])
+        else:
+            links.new(separate.outputs['Y'], combine.inputs['Y'])
+    else:
+        links.new(texCoord.outputs['UV'], texture.inputs['Vector'])
+
+    return texture
 
 def getCombinerOpOutput(nodes: list, links: list, source: Tuple[ShaderNode, ShaderNode], colourOp: TexCombinerColorOp) -> NodeSocket:
     match colourOp:
@@ -95,117 +108,481 @@ def getCombinerOpOutput(nodes: list, links: list, source: Tuple[ShaderNode, Shad
             channel = getSeparateRGBNode(nodes, links, invert.outputs["Color"])
             return channel.outputs['B']
 
-def getCombinerNodes(m: Material, stageIdx: int, stage: Combiner, textures: list, constantColourNodes: list, nodes: list, links: list,
-                     previous: Tuple[ShaderNode, ShaderNode], previousBuffer: Tuple[ShaderNode, ShaderNode], diffuse: Tuple[ShaderNode, ShaderNode], vertexColour: Tuple[ShaderNode, ShaderNode],
-                     mathNodeName, combinerMode: TexCombineMode,
-                     source0: TexCombinerSource, source1: TexCombinerSource, source2: TexCombinerSource,
-                     operand0: TexCombinerColorOp, operand1: TexCombinerColorOp, operand2: TexCombinerColorOp) -> NodeSocket:
-    src0 = getSourceNode(m, stage, textures, constantColourNodes,
-                         previous, previousBuffer, diffuse, vertexColour, nodes, source0)
-    src0output = getCombinerOpOutput(nodes, links, src0, operand0)
+def isAlphaOperand(operand: TexCombinerColorOp) -> bool:
+    return operand == TexCombinerColorOp.Alpha or operand == TexCombinerColorOp.OneMinusAlpha
 
-    if combinerMode == TexCombineMode.Replace:
-        return src0output
+def setDefaultValue(socket: NodeSocket, value: float):
+    # Vector math inputs take a value per component, math node inputs a single float
+    socket.default_value = (value, value, value) if hasattr(socket.default_value, '__len__') else value
 
+def getCombinerModeOutput(nodes: list, links: list, mathNodeName, combinerMode: TexCombineMode, sources: list) -> NodeSocket:
+    if combinerMode == TexCombineMode.Replace:
+        return sources[0]
+
+    elif combinerMode == TexCombineMode.Interpolate:
+        # Per channel like the hardware (and combinerBake), rather than a mix node's greyscale factor:
+        # source1 + (source0 - source1) * clamp(source2)
+        low = nodes.new(mathNodeName)
+        low.operation = 'MAXIMUM'
+        links.new(sources[2], low.inputs[0])
+        setDefaultValue(low.inputs[1], 0.0)
+
+        fac = nodes.new(mathNodeName)
+        fac.operation = 'MINIMUM'
+        links.new(low.outputs[0], fac.inputs[0])
+        setDefaultValue(fac.inputs[1], 1.0)
+
+        difference = nodes.new(mathNodeName)
+        difference.operation = 'SUBTRACT'
+        links.new(sources[0], difference.inputs[0])
+        links.new(sources[1], difference.inputs[1])
+
+        multiply = nodes.new(mathNodeName)
+        multiply.operation = 'MULTIPLY'
+        links.new(difference.outputs[0], multiply.inputs[0])
+        links.new(fac.outputs[0], multiply.inputs[1])
+
+        add = nodes.new(mathNodeName)
+        add.operation = 'ADD'
+        links.new(sources[1], add.inputs[0])
+        links.new(multiply.outputs[0], add.inputs[1])
+        return add.outputs[0]
+
+    elif combinerMode == TexCombineMode.MultAdd:
+        multiply = nodes.new(mathNodeName)
+        multiply.operation = 'MULTIPLY'
+        links.new(sources[0], multiply.inputs[0])
+        links.new(sources[1], multiply.inputs[1])
+
+        add = nodes.new(mathNodeName)
+        add.operation = 'ADD'
+        links.new(multiply.outputs[0], add.inputs[0])
+        links.new(sources[2], add.inputs[1])
+        return add.outputs[0]
+
+    elif combinerMode == TexCombineMode.AddMult:
+        add = nodes.new(mathNodeName)
+        add.operation = 'ADD'
+        links.new(sources[0], add.inputs[0])
+        links.new(sources[1], add.inputs[1])
+
+        multiply = nodes.new(mathNodeName)
+        multiply.operation = 'MULTIPLY'
+        links.new(add.outputs[0], multiply.inputs[0])
+        links.new(sources[2], multiply.inputs[1])
+        return multiply.outputs[0]
+
+    elif combinerMode == TexCombineMode.Modulate:
+        modulate = nodes.new(mathNodeName)
+        modulate.operation = 'MULTIPLY'
+        links.new(sources[0], modulate.inputs[0])
+        links.new(sources[1], modulate.inputs[1])
+        return modulate.outputs[0]
+
+    elif combinerMode == TexCombineMode.Add or combinerMode == TexCombineMode.AddSigned:
+        add = nodes.new(mathNodeName)
+        add.operation = 'ADD'
+        links.new(sources[0], add.inputs[0])
+        links.new(sources[1], add.inputs[1])
+        return add.outputs[0]
+
+    elif combinerMode == TexCombineMode.Subtract:
+        subtract = nodes.new(mathNodeName)
+        subtract.operation = 'SUBTRACT'
+        links.new(sources[0], subtract.inputs[0])
+        links.new(sources[1], subtract.inputs[1])
+        return subtract.outputs[0]
+
+    elif combinerMode == TexCombineMode.DotProduct3Rgb or combinerMode == TexCombineMode.DotProduct3Rgba:
+        dp = nodes.new("ShaderNodeVectorMath")
+        dp.operation = 'DOT_PRODUCT'
+        links.new(sources[0], dp.inputs[0])
+        links.new(sources[1], dp.inputs[1])
+
+        # Alpha?
+
+        return dp.outputs[0]
+
+def getCombinerGroup(isAlpha: bool, combinerMode: TexCombineMode, operands: tuple):
+    # One node group per combination, shared by every stage (of every material) that uses it
+    operands = operands[:getSourceCount(combinerMode)]
+    name = f"TEV {'Alpha' if isAlpha else 'Colour'} {combinerMode.name} ({', '.join(op.name for op in operands)})"
+    group = bpy.data.node_groups.get(name)
+    if group is not None:
+        return group
+
+    group = bpy.data.node_groups.new(name, 'ShaderNodeTree')
+    for i, operand in enumerate(operands):
+        group.inputs.new('NodeSocketFloat' if isAlphaOperand(operand) else 'NodeSocketColor', f'Source {i}')
+    group.inputs.new('NodeSocketFloat', 'Scale').default_value = 1.0
+    group.outputs.new('NodeSocketFloat' if isAlpha else 'NodeSocketColor', 'Result')
+
+    nodes = group.nodes
+    links = group.links
+    groupIn = nodes.new('NodeGroupInput')
+    groupOut = nodes.new('NodeGroupOutput')
+
+    # Each input is already the colour or alpha the operand reads, so it fills both slots
+    sources = [getCombinerOpOutput(nodes, links, (groupIn.outputs[i], groupIn.outputs[i]), operand)
+               for i, operand in enumerate(operands)]
+    result = getCombinerModeOutput(nodes, links, "ShaderNodeMath" if isAlpha else "ShaderNodeVectorMath", combinerMode, sources)
+
+    if isAlpha:
+        scale = nodes.new("ShaderNodeMath")
+        scale.operation = 'MULTIPLY'
+        links.new(result, scale.inputs[0])
+        links.new(groupIn.outputs['Scale'], scale.inputs[1])
+    else:
+        scale = nodes.new("ShaderNodeVectorMath")
+        scale.operation = 'SCALE'
+        links.new(result, scale.inputs[0])
+        links.new(groupIn.outputs['Scale'], scale.inputs['Scale'])
+    links.new(scale.outputs[0], groupOut.inputs['Result'])
+
+    return group
+
+class StagePlan(object):
+    def __init__(self):
+        # Folded values for outputs whose inputs are all constant, (r, g, b) and float
+        self.colour = None
+        self.alpha = None
+        # Whether the output reaches the shader (and so needs nodes or a literal)
+        self.colourLive = False
+        self.alphaLive = False
+
+def getStageChannels(stage: Combiner) -> tuple:
+    return ((False, stage.combinerModeColor, stage.scaleColor,
+             (stage.sourceColor0, stage.sourceColor1, stage.sourceColor2),
+             (stage.operandColor0, stage.operandColor1, stage.operandColor2)),
+            (True, stage.combinerModeAlpha, stage.scaleAlpha,
+             (stage.sourceAlpha0, stage.sourceAlpha1, stage.sourceAlpha2),
+             (stage.operandAlpha0, stage.operandAlpha1, stage.operandAlpha2)))
+
+def getSourceValue(m: Material, stage: Combiner, sourceType: TexCombinerSource, readsAlpha: bool, previous: StagePlan, previousBuffer: StagePlan):
+    # Previous stages of None mean the buffer colour
+    match sourceType:
+        case TexCombinerSource.Constant:
+            rgba = [c/255.0 for c in m.constantColors[stage.constColorIndex]]
+        case TexCombinerSource.FragmentPrimaryColor:
+            rgba = [b/255.0 for b in m.diffuseColor]
+        case TexCombinerSource.FragmentSecondaryColor:
+            rgba = [0.0, 0.0, 0.0, 1.0]
+        case TexCombinerSource.Previous | TexCombinerSource.PreviousBuffer:
+            plan = previous if sourceType == TexCombinerSource.Previous else previousBuffer
+            if plan is not None:
+                return plan.alpha if readsAlpha else plan.colour
+            rgba = [b/255.0 for b in m.bufferColor]
+        case _:
+            return None
+    return rgba[3] if readsAlpha else tuple(rgba[:3])
+
+def getOperandValue(value, operand: TexCombinerColorOp):
+    if value is None:
+        return None
+
+    match operand:
+        case TexCombinerColorOp.Color | TexCombinerColorOp.Alpha:
+            return value
+        case TexCombinerColorOp.Red:
+            return value[0]
+        case TexCombinerColorOp.Green:
+            return value[1]
+        case TexCombinerColorOp.Blue:
+            return value[2]
+        case TexCombinerColorOp.OneMinusColor:
+            return tuple(1.0 - v for v in value)
+        case TexCombinerColorOp.OneMinusAlpha:
+            return 1.0 - value
+        case TexCombinerColorOp.OneMinusRed:
+            return 1.0 - value[0]
+        case TexCombinerColorOp.OneMinusGreen:
+            return 1.0 - value[1]
+        case TexCombinerColorOp.OneMinusBlue:
+            return 1.0 - value[2]
+
+def combineValues(function, *values):
+    # Same broadcasting as the math nodes: floats apply to every channel of a colour
+    if not any(isinstance(v, tuple) for v in values):
+        return function(*values)
+    return tuple(function(*(v[i] if isinstance(v, tuple) else v for v in values)) for i in range(3))
+
+def getModeValue(combinerMode: TexCombineMode, values: list, scale: TexCombineScale, isAlpha: bool):
+    if any(v is None for v in values):
+        return None
+
+    match combinerMode:
+        case TexCombineMode.Replace:
+            result = values[0]
+        case TexCombineMode.Modulate:
+            result = combineValues(lambda a, b: a * b, *values)
+        case TexCombineMode.Add | TexCombineMode.AddSigned:
+            result = combineValues(lambda a, b: a + b, *values)
+        case TexCombineMode.Subtract:
+            result = combineValues(lambda a, b: a - b, *values)
+        case TexCombineMode.MultAdd:
+            result = combineValues(lambda a, b, c: a * b + c, *values)
+        case TexCombineMode.AddMult:
+            result = combineValues(lambda a, b, c: (a + b) * c, *values)
+        case TexCombineMode.Interpolate:
+            # Per channel, a colour factor mixes each channel by its own amount
+            result = combineValues(lambda a, b, fac: b * (1.0 - min(max(fac, 0.0), 1.0)) + a * min(max(fac, 0.0), 1.0), *values)
+        case _:
+            return None  # Dot products are left to the nodes
+
+    result = combineValues(lambda v: v * scale, result)
+    if isAlpha:
+        return None if isinstance(result, tuple) else result
+    return result if isinstance(result, tuple) else (result, result, result)
+
+def analyseCombiners(m: Material) -> list:
+    stages = m.texEnvStages[:m.texEnvStageCount]
+    plans = []
+
+    # Fold every output that only depends on constants
+    for stageIdx, stage in enumerate(stages):
+        plan = StagePlan()
+        previous = plans[stageIdx - 1] if stageIdx >= 1 else None
+        previousBuffer = plans[stageIdx - 2] if stageIdx >= 2 else None
+
+        for isAlpha, combinerMode, scale, sourceTypes, operands in getStageChannels(stage):
+            values = [getOperandValue(getSourceValue(m, stage, sourceTypes[i], isAlphaOperand(operands[i]), previous, previousBuffer), operands[i])
+                      for i in range(getSourceCount(combinerMode))]
+            if isAlpha:
+                plan.alpha = getModeValue(combinerMode, values, scale, isAlpha)
+            else:
+                plan.colour = getModeValue(combinerMode, values, scale, isAlpha)
+
+        plans.append(plan)
+
+    # Walk back from the shader to find which outputs are actually read
+    if len(plans) > 0:
+        plans[-1].colourLive = plans[-1].alphaLive = True
+
+    for stageIdx in reversed(range(len(stages))):
+        plan = plans[stageIdx]
+        for isAlpha, combinerMode, scale, sourceTypes, operands in getStageChannels(stages[stageIdx]):
+            live = plan.alphaLive if isAlpha else plan.colourLive
+            folded = (plan.alpha if isAlpha else plan.colour) is not None
+            if not live or folded:
+                continue
+
+            for i in range(getSourceCount(combinerMode)):
+                match sourceTypes[i]:
+                    case TexCombinerSource.Previous:
+                        source = stageIdx - 1
+                    case TexCombinerSource.PreviousBuffer:
+                        source = stageIdx - 2
+                    case _:
+                        continue
+                if source < 0:
+                    continue
+                if isAlphaOperand(operands[i]):
+                    plans[source].alphaLive = True
+                else:
+                    plans[source].colourLive = True
+
+    return plans
+
+class CombinerSockets(object):
+    # Creates source nodes the first time a live stage reads them
+    def __init__(self, m: Material, nodes, links, textureImages: list, plans: list):
+        self.m = m
+        self.nodes = nodes
+        self.links = links
+        self.textureImages = textureImages
+        self.plans = plans
+        self.textures = {}
+        self.constants = {}
+        self.stageOutputs = {}
+        self.vertexColour = None
+
+    def getConstant(self, label: str, rgba: list, readsAlpha: bool) -> NodeSocket:
+        key = (label, readsAlpha)
+        if key not in self.constants:
+            if readsAlpha:
+                node = self.nodes.new("ShaderNodeValue")
+                node.label = f"{label} Alpha"
+                node.outputs['Value'].default_value = rgba[3]
+            else:
+                node = self.nodes.new("ShaderNodeRGB")
+                node.label = f"{label} Colour"
+                node.outputs['Color'].default_value = Vector(rgba)
+            self.constants[key] = node.outputs[0]
+        return self.constants[key]
+
+    def getTexture(self, index: int) -> ShaderNode:
+        if index not in self.textures:
+            tm = self.m.TextureMappers[index]
+            self.textures[index] = getTextureNode(self.nodes, self.links, tm, self.m.TextureCoords[index],
+                                                  self.textureImages[tm.textureID])
+        return self.textures[index]
+
+    def getStageOutput(self, stageIdx: int, isAlpha: bool) -> NodeSocket:
+        if stageIdx < 0:
+            return self.getConstant("Buffer", [b/255.0 for b in self.m.bufferColor], isAlpha)
+
+        if (stageIdx, isAlpha) in self.stageOutputs:
+            return self.stageOutputs[(stageIdx, isAlpha)]
+
+        # Folded stages are emitted as literals
+        plan = self.plans[stageIdx]
+        rgba = [0.0, 0.0, 0.0, plan.alpha] if isAlpha else [*plan.colour, 1.0]
+        return self.getConstant(f"Stage {stageIdx}", rgba, isAlpha)
+
+    def getSource(self, stageIdx: int, stage: Combiner, sourceType: TexCombinerSource, readsAlpha: bool) -> NodeSocket:
+        output = 'Alpha' if readsAlpha else 'Color'
+        match sourceType:
+            case TexCombinerSource.Texture0:
+                return self.getTexture(0).outputs[output]
+            case TexCombinerSource.Texture1:
+                return self.getTexture(1).outputs[output]
+            case TexCombinerSource.Texture2:
+                return self.getTexture(2).outputs[output]
+            case TexCombinerSource.Texture3:
+                return self.getTexture(3).outputs[output]
+            case TexCombinerSource.PrimaryColor:
+                if self.vertexColour is None:
+                    self.vertexColour = self.nodes.new("ShaderNodeVertexColor")
+                    self.vertexColour.label = "Fragment Primary Colour"
+                return self.vertexColour.outputs[output]
+            case TexCombinerSource.Constant:
+                index = stage.constColorIndex
+                return self.getConstant(f"Constant {index}", [c/255.0 for c in self.m.constantColors[index]], readsAlpha)
+            case TexCombinerSource.Previous:
+                return self.getStageOutput(stageIdx - 1, readsAlpha)
+            case TexCombinerSource.PreviousBuffer:
+                return self.getStageOutput(stageIdx - 2, readsAlpha)
+            case TexCombinerSource.FragmentPrimaryColor:
+                return self.getConstant("Diffuse", [b/255.0 for b in self.m.diffuseColor], readsAlpha)
+            case TexCombinerSource.FragmentSecondaryColor:
+                return self.getConstant("Fragment Secondary", [0.0, 0.0, 0.0, 1.0], readsAlpha)
+
+def getCombinerNodes(sockets: CombinerSockets, stageIdx: int, stage: Combiner, nodes: list, links: list,
+                     isAlpha: bool, combinerMode: TexCombineMode, scale: TexCombineScale, sourceTypes: tuple, operands: tuple) -> NodeSocket:
+    stageNode = nodes.new("ShaderNodeGroup")
+    stageNode.node_tree = getCombinerGroup(isAlpha, combinerMode, operands)
+    stageNode.label = f"Stage {stageIdx} {'Alpha' if isAlpha else 'Colour'}"
+    stageNode.inputs['Scale'].default_value = scale
+
+    for i in range(getSourceCount(combinerMode)):
+        source = sockets.getSource(stageIdx, stage, sourceTypes[i], isAlphaOperand(operands[i]))
+        links.new(source, stageNode.inputs[f'Source {i}'])
+
+    return stageNode.outputs['Result']
+
+def generateBakedNodes(m: Material, name: str, nodes, links, sdr: ShaderNode, textureImages: list) -> bool:
+    used = [i for i in range(m.TextureMappersUsed) if m.TextureMappers[i].textureID >= 0]
+    if any(textureImages[m.TextureMappers[i].textureID] is None for i in used):
+        return False
+    if len({m.TextureCoords[i].uvChannel for i in used}) > 1:
+        return False  # Textures on different UV maps can't be baked into one
+
+    images = {i: textureImages[m.TextureMappers[i].textureID] for i in used}
+    width = max([image.size[0] for image in images.values()], default=1)
+    height = max([image.size[1] for image in images.values()], default=1)
+
+    try:
+        pixels, usesVertexColour = bakeCombiners(m, {i: getImagePixels(image) for i, image in images.items()}, width, height)
+    except (KeyError, IndexError):
+        return False  # A stage reads a texture the material doesn't map
+
+    image = bpy.data.images.new(f"{name}_baked", width, height, alpha=True)
+    image.pixels.foreach_set(pixels.ravel())
+    image.pack()
+
+    if len(used) > 0:
+        texture = getTextureNode(nodes, links, m.TextureMappers[used[0]], m.TextureCoords[used[0]], image)
     else:
-        src1 = getSourceNode(m, stage, textures, constantColourNodes,
-                             previous, previousBuffer, diffuse, vertexColour, nodes, source1)
-        src1output = getCombinerOpOutput(nodes, links, src1, operand1)
-
-        if combinerMode == TexCombineMode.Interpolate \
-           or combinerMode == TexCombineMode.MultAdd \
-           or combinerMode == TexCombineMode.AddMult:
-
-            src2 = getSourceNode(m, stage, textures, constantColourNodes,
-                                 previous, previousBuffer, diffuse, vertexColour, nodes, source2)
-            src2output = getCombinerOpOutput(nodes, links, src2, operand2)
-
-            if combinerMode == TexCombineMode.Interpolate:
-                interp = nodes.new("ShaderNodeMixRGB")
-                links.new(src0output, interp.inputs['Color2'])
-                links.new(src1output, interp.inputs['Color1'])
-                links.new(src2output, interp.inputs['Fac'])
-                interp.label = f"Stage {stageIdx}"
-                return interp.outputs['Color']
-
-            elif combinerMode == TexCombineMode.MultAdd:
-                multiply = nodes.new(mathNodeName)
-                multiply.operation = 'MULTIPLY'
-                links.new(src0output, multiply.inputs[0])
-                links.new(src1output, multiply.inputs[1])
-
-                add = nodes.new(mathNodeName)
-                add.operation = 'ADD'
-                links.new(multiply.outputs[0], add.inputs[0])
-                links.new(src2output, add.inputs[1])
-                add.label = f"Stage {stageIdx}"
-                return add.outputs[0]
-
-            elif combinerMode == TexCombineMode.AddMult:
-                add = nodes.new(mathNodeName)
-                add.operation = 'ADD'
-                links.new(src0output, add.inputs[0])
-                links.new(src1output, add.inputs[1])
-
-                multiply = nodes.new(mathNodeName)
-                multiply.operation = 'MULTIPLY'
-                links.new(add.outputs[0], multiply.inputs[0])
-                links.new(src2output, multiply.inputs[1])
-                multiply.label = f"Stage {stageIdx}"
-                return multiply.outputs[0]
-
-        elif combinerMode == TexCombineMode.Modulate:
-            modulate = nodes.new(mathNodeName)
-            modulate.operation = 'MULTIPLY'
-            links.new(src0output, modulate.inputs[0])
-            links.new(src1output, modulate.inputs[1])
-            modulate.label = f"Stage {stageIdx}"
-            return modulate.outputs[0]
-
-        elif combinerMode == TexCombineMode.Add:
-            add = nodes.new(mathNodeName)
-            add.operation = 'ADD'
-            links.new(src0output, add.inputs[0])
-            links.new(src1output, add.inputs[1])
-            add.label = f"Stage {stageIdx}"
-            return add.outputs[0]
-
-        elif combinerMode == TexCombineMode.AddSigned:
-            add = nodes.new(mathNodeName)
-            add.operation = 'ADD'
-            links.new(src0output, add.inputs[0])
-            links.new(src1output, add.inputs[1])
-            add.label = f"Stage {stageIdx}"
-            return add.outputs[0]
-
-        elif combinerMode == TexCombineMode.Subtract:
-            subtract = nodes.new(mathNodeName)
-            subtract.operation = 'SUBTRACT'
-            links.new(src0output, subtract.inputs[0])
-            links.new(src1output, subtract.inputs[1])
-            subtract.label = f"Stage {stageIdx}"
-            return subtract.outputs[0]
-
-        elif combinerMode == TexCombineMode.DotProduct3Rgb:
-            dp = nodes.new("ShaderNodeVectorMath")
-            dp.operation = 'DOT_PRODUCT'
-            links.new(src0output, dp.inputs[0])
-            links.new(src1output, dp.inputs[1])
-            dp.label = f"Stage {stageIdx}"
-            return dp.outputs[0]
-
-        elif combinerMode == TexCombineMode.DotProduct3Rgba:
-            dp = nodes.new("ShaderNodeVectorMath")
-            dp.operation = 'DOT_PRODUCT'
-            links.new(src0output, dp.inputs[0])
-            links.new(src1output, dp.inputs[1])
-
-            # Alpha?
-
-            dp.label = f"Stage {stageIdx}"
-            return dp.outputs[0]
-
-def generateMaterial(m: Material, name: str, materialNames: list, textureNames: list):
+        texture = nodes.new("ShaderNodeTexImage")
+        texture.image = image
+    colour = texture.outputs['Color']
+    alpha = texture.outputs['Alpha']
+
+    if usesVertexColour:
+        vertexColour = nodes.new("ShaderNodeVertexColor")
+        vertexColour.label = "Fragment Primary Colour"
+
+        multiply = nodes.new("ShaderNodeMixRGB")
+        multiply.blend_type = 'MULTIPLY'
+        multiply.inputs['Fac'].default_value = 1.0
+        links.new(colour, multiply.inputs['Color1'])
+        links.new(vertexColour.outputs['Color'], multiply.inputs['Color2'])
+        colour = multiply.outputs['Color']
+
+        multiply = nodes.new("ShaderNodeMath")
+        multiply.operation = 'MULTIPLY'
+        links.new(alpha, multiply.inputs[0])
+        links.new(vertexColour.outputs['Alpha'], multiply.inputs[1])
+        alpha = multiply.outputs[0]
+
+    links.new(colour, sdr.inputs['Base Color'])
+    links.new(alpha, sdr.inputs['Alpha'])
+    return True
+
+def getStateTuple(o) -> tuple:
+    return tuple((key, tuple(value) if isinstance(value, list) else value) for key, value in sorted(vars(o).items()))
+
+def getMaterialKey(m: Material, textureImages: list) -> str:
+    # Everything that affects the generated node tree, with textures resolved to their images
+    state = (
+        m.alphaTestEnabled, m.alphaTestReferenceValue, m.alphaTestFunction,
+        m.blendMode, m.alphaSrcFunc, m.alphaDstFunc, m.alphaEquation,
+        m.colorSrcFunc, m.colorDstFunc, m.colorEquation, tuple(m.blendColor),
+        tuple(getattr(textureImages[tm.textureID], 'name', None) if tm.textureID >= 0 else None for tm in m.TextureMappers[:m.TextureMappersUsed]),
+        tuple(getStateTuple(tm) for tm in m.TextureMappers[:m.TextureMappersUsed]),
+        tuple(getStateTuple(tc) for tc in m.TextureCoords[:m.TextureMappersUsed]),
+        tuple(m.emissionColor), tuple(m.ambientColor), tuple(m.diffuseColor),
+        tuple(m.specular0Color), tuple(m.specular1Color), tuple(m.bufferColor),
+        tuple(tuple(c) for c in m.constantColors),
+        tuple(getStateTuple(stage) for stage in m.texEnvStages[:m.texEnvStageCount]),
+    )
+    return hashlib.sha1(repr(state).encode()).hexdigest()
+
+# Materials waiting for their node trees, built a few at a time by buildQueuedMaterials. They're
+# kept by name and looked up when built, as an undo or a file load between ticks frees the datablocks.
+materialQueue = deque()
+MaterialTickBudget = 0.02  # Seconds of node building per timer tick
+MaterialTickInterval = 0.01
+
+def queueMaterial(mat, m: Material, textureImages: list, bake: bool):
+    materialQueue.append((mat.name, m, [image.name if image is not None else None for image in textureImages], bake))
+    if not bpy.app.timers.is_registered(buildQueuedMaterialsTick):
+        bpy.app.timers.register(buildQueuedMaterialsTick, first_interval=MaterialTickInterval)
+
+def buildQueuedMaterials(deadline: float = None) -> bool:
+    # Builds at least one queued material, then more until the deadline (all of them without one).
+    # Returns whether any are left.
+    while len(materialQueue) > 0:
+        name, m, imageNames, bake = materialQueue.popleft()
+        mat = bpy.data.materials.get(name)
+        if mat is not None:  # Otherwise it was removed before we got to it
+            textureImages = [bpy.data.images.get(imageName) if imageName is not None else None for imageName in imageNames]
+            try:
+                buildMaterialNodes(mat, m, textureImages, bake)
+            except Exception as ex:
+                # Keeps going, so one bad material doesn't leave the rest of the queue as placeholders
+                print(f"Failed to build material {name}")
+                print(ex)
+        if deadline is not None and time.perf_counter() >= deadline:
+            break
+
+    return len(materialQueue) > 0
+
+def buildQueuedMaterialsTick():
+    return MaterialTickInterval if buildQueuedMaterials(time.perf_counter() + MaterialTickBudget) else None
+
+@persistent
+def clearMaterialQueue(*args):
+    # Registered as a load_pre handler, the queued names would otherwise match the next file's materials
+    materialQueue.clear()
+
+def generateMaterial(m: Material, name: str, materialNames: list, textureImages: list, materialCache: dict = None, bake: bool = False, defer: bool = False):
+    # Identical materials (across every model of the import) share one datablock
+    key = getMaterialKey(m, textureImages) if materialCache is not None else None
+    if key is not None and key in materialCache:
+        materialNames.append(materialCache[key].name)
+        return materialCache[key]
+
     mat = bpy.data.materials.new('{}_mat'.format(name))  # Create new material
     mat.use_nodes = True  # Use nodes
     mat.use_backface_culling = True
@@ -223,149 +600,49 @@ def generateMaterial(m: Material, name: str, materialNames: list, textureNames:
     if m.alphaTestEnabled:
         mat.blend_method = 'BLEND'
 
-    textures = []
-    for i in range(m.TextureMappersUsed):
-        tm = m.TextureMappers[i]
-        tc = m.TextureCoords[i]
-
-        # Create new texture node
-        texture = nodes.new("ShaderNodeTexImage")
+    # These are actual colours, so they work
+    sdr.inputs['Subsurface Color'].default_value = Vector([b/255.0 for b in m.ambientColor])
+    sdr.inputs['Emission'].default_value = Vector([b/255.0 for b in m.emissionColor])
 
-        # Set the texture's image
-        image = bpy.data.images.get(textureNames[tm.textureID])
-        if image is None:
-            image = bpy.data.images.load(textureNames[tm.textureID])
-        texture.image = image
-        textures.append(texture)
+    # BSDF doesn't support tinted specular because it's determined by the light source.
+    # So instead we just use the Green channel as that contributes most to intensity.
+    sdr.inputs['Roughness'].default_value = m.specular0Color[1]/255.0
+    sdr.inputs['Specular'].default_value = m.specular1Color[1]/255.0
 
-        #print("material: {}, texture: {}".format(matIdx, textureNames[tm.textureID]))
+    # Stands in until the combiners are linked in
+    sdr.inputs['Base Color'].default_value = Vector([b/255.0 for b in m.diffuseColor])
 
-        texCoord = nodes.new("ShaderNodeUVMap")
-        texCoord.uv_map = f"UV{tc.uvChannel}"
+    if defer:
+        queueMaterial(mat, m, textureImages, bake)
+    else:
+        buildMaterialNodes(mat, m, textureImages, bake)
 
-        if tm.wrapS == TextureWrapMode.Mirror or tm.wrapT == TextureWrapMode.Mirror:
-            separate = nodes.new('ShaderNodeSeparateXYZ')
-            combine = nodes.new('ShaderNodeCombineXYZ')
-            links.new(texCoord.outputs['UV'], separate.inputs['Vector'])
-            links.new(combine.outputs['Vector'], texture.inputs['Vector'])
+    if key is not None:
+        materialCache[key] = mat
+    return mat
 
-            if tm.wrapS == TextureWrapMode.Mirror:
-                pingpong = nodes.new('ShaderNodeMath')
-                pingpong.operation = 'PINGPONG'
-                pingpong.inputs[1].default_value = 1.0  # Scale
-                links.new(separate.outputs['X'], pingpong.inputs['Value'])
-                links.new(pingpong.outputs['Value'], combine.inputs['X'])
-            else:
-                links.new(separate.outputs['X'], combine.inputs['X'])
-
-            if tm.wrapT == TextureWrapMode.Mirror:
-                pingpong = nodes.new('ShaderNodeMath')
-                pingpong.operation = 'PINGPONG'
-                pingpong.inputs[1].default_value = 1.0  # Scale
-                links.new(separate.outputs['Y'], pingpong.inputs['Value'])
-                links.new(pingpong.outputs['Value'], combine.inputs['Y'])
-            else:
-                links.new(separate.outputs['Y'], combine.inputs['Y'])
-        else:
-            links.new(texCoord.outputs['UV'], texture.inputs['Vector'])
+def buildMaterialNodes(mat, m: Material, textureImages: list, bake: bool):
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    sdr = nodes.get("Principled BSDF")
 
-    constantColourNodes = [None] * len(m.constantColors)
+    if bake and generateBakedNodes(m, mat.name, nodes, links, sdr, textureImages):
+        return
 
-    for c in range(len(m.constantColors)):
-        colour = nodes.new("ShaderNodeRGB")
-        colour.label = "Constant {} Colour".format(c)
-        colour.outputs['Color'].default_value = Vector([n/255.0 for n in m.constantColors[c]])
-        alpha = nodes.new("ShaderNodeValue")
-        alpha.label = "Constant {} Alpha".format(c)
-        alpha.outputs['Value'].default_value = m.constantColors[c][-1]/255.0
-        constantColourNodes[c] = (colour, alpha)
+    # Only stages that reach the shader get nodes, and constant ones are folded to literals
+    plans = analyseCombiners(m)
+    sockets = CombinerSockets(m, nodes, links, textureImages, plans)
 
-    # These are actual colours, so they work
-    sdr.inputs['Subsurface Color'].default_value = Vector([b/255.0 for b in m.ambientColor])
-    sdr.inputs['Emission'].default_value = Vector([b/255.0 for b in m.emissionColor])
+    for stageIdx, stage in enumerate(m.texEnvStages[:m.texEnvStageCount]):
+        plan = plans[stageIdx]
 
-    # BSDF doesn't support tinted specular because it's determined by the light source.
-    # So instead we just use the Green channel as that contributes most to intensity.
-    sdr.inputs['Roughness'].default_value = m.specular0Color[1]/255.0
-    sdr.inputs['Specular'].default_value = m.specular1Color[1]/255.0
+        for isAlpha, combinerMode, scale, sourceTypes, operands in getStageChannels(stage):
+            live = plan.alphaLive if isAlpha else plan.colourLive
+            folded = (plan.alpha if isAlpha else plan.colour) is not None
+            if live and not folded:
+                sockets.stageOutputs[(stageIdx, isAlpha)] = getCombinerNodes(sockets, stageIdx, stage, nodes, links,
+                                                                             isAlpha, combinerMode, scale, sourceTypes, operands)
 
-    vertexColourNode = nodes.new("ShaderNodeVertexColor")
-    vertexColourNode.label = "Fragment Primary Colour"
-    vertexColour = (vertexColourNode.outputs['Color'], vertexColourNode.outputs['Alpha'])
-
-    colour = nodes.new("ShaderNodeRGB")
-    colour.label = "Diffuse Colour"
-    colour.outputs['Color'].default_value = Vector([b/255.0 for b in m.diffuseColor])
-    alpha = nodes.new("ShaderNodeValue")
-    alpha.label = "Diffuse Alpha"
-    alpha.outputs['Value'].default_value = m.diffuseColor[-1] / 255.0
-    diffuseNodes = (colour, alpha)
-    diffuse = (colour.outputs['Color'], alpha.outputs['Value'])
-
-    colour = nodes.new("ShaderNodeRGB")
-    colour.label = "Buffer Colour"
-    colour.outputs['Color'].default_value = Vector([b/255.0 for b in m.bufferColor])
-    alpha = nodes.new("ShaderNodeValue")
-    alpha.label = "Buffer Alpha"
-    alpha.outputs['Value'].default_value = m.bufferColor[-1] / 255.0
-    bufferNodes = (colour, alpha)
-    buffer = (colour.outputs['Color'], alpha.outputs['Value'])
-    previous = bufferNodes
-    previousBuffer = bufferNodes
-
-    for stageIdx in range(m.texEnvStageCount):
-        stage = m.texEnvStages[stageIdx]
-
-        colour = getCombinerNodes(m, stageIdx, stage, textures, constantColourNodes, nodes, links,
-                                    previous, previousBuffer, diffuse, vertexColour,
-                                    "ShaderNodeVectorMath", stage.combinerModeColor,
-                                    stage.sourceColor0, stage.sourceColor1, stage.sourceColor2,
-                                    stage.operandColor0, stage.operandColor1, stage.operandColor2)
-
-        if colour is None:
-            raise ValueError("Colour cannot be none")
-
-        if stage.scaleColor != 1:
-            scale = nodes.new("ShaderNodeVectorMath")
-            scale.operation = 'MULTIPLY'
-            links.new(colour, scale.inputs[0])
-            scale.inputs[1].default_value = (stage.scaleColor, stage.scaleColor, stage.scaleColor)
-            colour = scale.outputs[0]
-
-        alpha = getCombinerNodes(m, stageIdx, stage, textures, constantColourNodes, nodes, links,
-                                    previous, previousBuffer, diffuse, vertexColour,
-                                    "ShaderNodeMath", stage.combinerModeAlpha,
-                                    stage.sourceAlpha0, stage.sourceAlpha1, stage.sourceAlpha2,
-                                    stage.operandAlpha0, stage.operandAlpha1, stage.operandAlpha2)
-
-        if stage.scaleAlpha != 1:
-            scale = nodes.new("ShaderNodeMath")
-            scale.operation = 'MULTIPLY'
-            links.new(alpha, scale.inputs[0])
-            scale.inputs[1].default_value = stage.scaleAlpha
-            alpha = scale.outputs[0]
-
-        previousBuffer = previous
-        previous = (colour, alpha)
-
-    links.new(previous[0], sdr.inputs['Base Color'])
-    links.new(previous[1], sdr.inputs['Alpha'])
-
-    for (colour, alpha) in constantColourNodes:
-        if len(colour.outputs[0].links) == 0:
-            nodes.remove(colour)
-        if len(alpha.outputs[0].links) == 0:
-            nodes.remove(alpha)
-
-    if len(vertexColour[0].links) == 0 and len(vertexColour[1].links) == 0:
-        nodes.remove(vertexColourNode)
-
-    if len(diffuse[0].links) == 0:
-        nodes.remove(diffuseNodes[0])
-    if len(diffuse[1].links) == 0:
-        nodes.remove(diffuseNodes[1])
-
-    if len(buffer[0].links) == 0:
-        nodes.remove(bufferNodes[0])
-    if len(buffer[1].links) == 0:
-        nodes.remove(bufferNodes[1])
\ No newline at end of file
+    lastStage = len(plans) - 1
+    links.new(sockets.getStageOutput(lastStage, False), sdr.inputs['Base Color'])
+    links.new(sockets.getStageOutput(lastStage, True), sdr.inputs['Alpha'])
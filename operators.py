@@ -0,0 +1,207 @@
+import bpy, time, traceback
+from bpy.props import *
+from bpy_extras.io_utils import ImportHelper
+
+ImportTickBudget = 0.05  # Seconds of importing per timer tick, between which Blender handles input and redraws
+ImportTickInterval = 0.01
+
+# Events passed on to Blender during an import, so the view can still be moved around and redrawn.
+# Everything else (undo, mode and selection changes...) is blocked, as the loader holds on to
+# datablocks that those could free or move between steps.
+ImportPassThroughEvents = {
+    'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE',
+    'TRACKPADPAN', 'TRACKPADZOOM', 'MOUSEROTATE', 'MOUSESMARTZOOM', 'NDOF_MOTION',
+    'TIMER', 'TIMER_REPORT', 'TIMERREGION', 'WINDOW_DEACTIVATE',
+}
+
+class ModalImport(object):
+    # Runs the loader's steps (see utils.runSteps) from a timer, showing progress. Esc stops the
+    # import after the current step and keeps what was imported up to then. Deferred materials are
+    # finished before the operator returns, so its undo step holds the full node trees.
+    # The operators provide getSteps, returning their loader's iter*Files generator.
+    def execute( self, context ):
+        from .materials import buildQueuedMaterials
+        self.steps = self.getSteps()
+        self.result = None  # Report shown once the materials are done, if the import was cancelled or failed
+        if context.window is None:
+            # Background mode, or called from a script without a window: nothing to show progress in
+            for _ in self.steps:
+                pass
+            buildQueuedMaterials()
+            return {'FINISHED'}
+
+        wm = context.window_manager
+        wm.progress_begin(0, 100)
+        self.timer = wm.event_timer_add(ImportTickInterval, window=context.window)
+        wm.modal_handler_add(self)
+        return {'RUNNING_MODAL'}
+
+    def modal( self, context, event ):
+        if event.type == 'ESC' and event.value == 'PRESS' and self.steps is not None:
+            self.steps.close()  # Runs the loader's clean up, e.g. building the skeletons loaded so far
+            self.steps = None
+            self.result = ({'WARNING'}, "Import cancelled, the models loaded so far were kept")
+            return {'RUNNING_MODAL'}  # The placeholder materials of those models are still finished
+
+        if event.type != 'TIMER' or event.timer != self.timer:
+            return {'PASS_THROUGH'} if event.type in ImportPassThroughEvents else {'RUNNING_MODAL'}
+
+        deadline = time.perf_counter() + ImportTickBudget
+        if self.steps is not None:
+            try:
+                progress = next(self.steps)
+                while time.perf_counter() < deadline:
+                    progress = next(self.steps)
+            except StopIteration:
+                self.steps = None
+            except Exception as ex:
+                print("Failed to import")
+                traceback.print_exc()
+                self.steps = None
+                self.result = ({'ERROR'}, f"Import failed: {ex}")
+            else:
+                progress = progress or 0
+                context.window_manager.progress_update(progress * 100)
+                context.workspace.status_text_set(f"Importing... {progress * 100:.0f}% (Esc to cancel)")
+                return {'RUNNING_MODAL'}
+
+        from .materials import buildQueuedMaterials, materialQueue
+        if buildQueuedMaterials(deadline):
+            context.workspace.status_text_set(f"Building materials... {len(materialQueue)} left")
+            return {'RUNNING_MODAL'}
+
+        # Not CANCELLED even if Esc was pressed, so the partial import gets an undo step (see bl_options)
+        self.finish(context)
+        if self.result is not None:
+            self.report(*self.result)
+        return {'FINISHED'}
+
+    def finish( self, context ):
+        wm = context.window_manager
+        wm.event_timer_remove(self.timer)
+        wm.progress_end()
+        context.workspace.status_text_set(None)
+
+# ################################################################
+# Import/Export
+# ################################################################
+class ImportCmb(bpy.types.Operator, ImportHelper, ModalImport):
+    bl_idname = "import.cmb"
+    bl_label = "Import CMB"
+    bl_options = {'UNDO'}
+    
+    filename_ext = ".cmb"
+    filter_glob: bpy.props.StringProperty(default="*.cmb", options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
+
+    use_custom_normals: bpy.props.BoolProperty(name="Custom Normals", description="Use the model's normals as custom split normals", default=True)
+    bake_combiners: bpy.props.BoolProperty(name="Bake Combiners", description="Evaluate each material's texture combiners into a single texture instead of building the node graph", default=False)
+    defer_materials: bpy.props.BoolProperty(name="Defer Materials", description="Show placeholder materials straight away and build the full node trees in the background", default=False)
+    analyse_uv_wraps: bpy.props.BoolProperty(name="Analyse UV Wraps", description="Print UV islands that cross the texture repeat boundary", default=False)
+    profile_import: bpy.props.BoolProperty(name="Profile", description="Print the time spent in each stage of the import to the console", default=False)
+    profile_json: bpy.props.StringProperty(name="Profile JSON", description="Also write the timings to this JSON file. Leave empty to only print them", subtype='FILE_PATH', default="")
+        
+    def getSteps( self ):
+        from .import_cmb import iterCmbFiles
+        return iterCmbFiles(self)
+        
+class ImportGar(bpy.types.Operator, ImportHelper, ModalImport):
+    bl_idname = "import.gar"
+    bl_label = "Import GAR"
+    bl_options = {'UNDO'}
+    
+    filename_ext = ".gar"
+    filter_glob: bpy.props.StringProperty(default="*.gar", options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
+
+    use_custom_normals: bpy.props.BoolProperty(name="Custom Normals", description="Use the model's normals as custom split normals", default=True)
+    bake_combiners: bpy.props.BoolProperty(name="Bake Combiners", description="Evaluate each material's texture combiners into a single texture instead of building the node graph", default=False)
+    defer_materials: bpy.props.BoolProperty(name="Defer Materials", description="Show placeholder materials straight away and build the full node trees in the background", default=False)
+    analyse_uv_wraps: bpy.props.BoolProperty(name="Analyse UV Wraps", description="Print UV islands that cross the texture repeat boundary", default=False)
+    profile_import: bpy.props.BoolProperty(name="Profile", description="Print the time spent in each stage of the import to the console", default=False)
+    profile_json: bpy.props.StringProperty(name="Profile JSON", description="Also write the timings to this JSON file. Leave empty to only print them", subtype='FILE_PATH', default="")
+    proxy_mode: bpy.props.EnumProperty(name="Proxies", description="Import stand-in geometry for layout work, without textures or materials", items=[
+        ('NONE', "Full Models", "Import the complete models"),
+        ('BOUNDS', "Bounding Boxes", "A box around each shape"),
+        ('DECIMATED', "Decimated", "Each shape's triangles simplified to a coarse grid"),
+    ], default='NONE')
+        
+    def getSteps( self ):
+        from .import_gar import iterGarFiles
+        return iterGarFiles(self)
+        
+class ImportGseb(bpy.types.Operator, ImportHelper, ModalImport):
+    bl_idname = "import.gseb"
+    bl_label = "Import GSEB"
+    bl_options = {'UNDO'}
+    
+    filename_ext = ".gseb"
+    filter_glob: bpy.props.StringProperty(default="*.gseb", options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
+
+    use_custom_normals: bpy.props.BoolProperty(name="Custom Normals", description="Use the model's normals as custom split normals", default=True)
+    bake_combiners: bpy.props.BoolProperty(name="Bake Combiners", description="Evaluate each material's texture combiners into a single texture instead of building the node graph", default=False)
+    defer_materials: bpy.props.BoolProperty(name="Defer Materials", description="Show placeholder materials straight away and build the full node trees in the background", default=False)
+    analyse_uv_wraps: bpy.props.BoolProperty(name="Analyse UV Wraps", description="Print UV islands that cross the texture repeat boundary", default=False)
+    profile_import: bpy.props.BoolProperty(name="Profile", description="Print the time spent in each stage of the import to the console", default=False)
+    profile_json: bpy.props.StringProperty(name="Profile JSON", description="Also write the timings to this JSON file. Leave empty to only print them", subtype='FILE_PATH', default="")
+    instance_models: bpy.props.BoolProperty(name="Instance Models", description="Load each model once and place every scene object that uses it as a collection instance", default=True)
+    prefetch_models: bpy.props.BoolProperty(name="Parallel Prefetch", description="Read the scene's models and decode their textures in parallel before building them", default=True)
+    rooms: bpy.props.StringProperty(name="Rooms", description="Only import these rooms, e.g. \"0, 3, 5-7\". Leave empty for all of them", default="")
+    use_region: bpy.props.BoolProperty(name="Limit to Region", description="Only import objects whose bounds overlap the region below", default=False)
+    region_min: bpy.props.FloatVectorProperty(name="Region Min", description="Lowest corner of the region, in scene file units", size=3, default=(-1000.0, -1000.0, -1000.0))
+    region_max: bpy.props.FloatVectorProperty(name="Region Max", description="Highest corner of the region, in scene file units", size=3, default=(1000.0, 1000.0, 1000.0))
+    proxy_mode: bpy.props.EnumProperty(name="Proxies", description="Import stand-in geometry for layout work, without textures or materials", items=[
+        ('NONE', "Full Models", "Import the complete models"),
+        ('BOUNDS', "Bounding Boxes", "A box around each shape"),
+        ('DECIMATED', "Decimated", "Each shape's triangles simplified to a coarse grid"),
+    ], default='NONE')
+        
+    def getSteps( self ):
+        from .gseb import iterGsebFiles
+        return iterGsebFiles(self)
+    
+class ImportCtxb(bpy.types.Operator, ImportHelper, ModalImport):
+    bl_idname = "import.ctxb"
+    bl_label = "Import CTXB"
+    bl_options = {'UNDO'}
+    
+    filename_ext = ".ctxb"
+    filter_glob: bpy.props.StringProperty(default="*.ctxb", options={'HIDDEN'})
+    files: bpy.props.CollectionProperty(type=bpy.types.OperatorFileListElement, options={'HIDDEN', 'SKIP_SAVE'})
+    directory: bpy.props.StringProperty(subtype='FILE_PATH', options={'HIDDEN', 'SKIP_SAVE'})
+
+    profile_import: bpy.props.BoolProperty(name="Profile", description="Print the time spent in each stage of the import to the console", default=False)
+    profile_json: bpy.props.StringProperty(name="Profile JSON", description="Also write the timings to this JSON file. Leave empty to only print them", subtype='FILE_PATH', default="")
+        
+    def getSteps( self ):
+        from .import_ctxb import iterCtxbFiles
+        return iterCtxbFiles(self)
+
+class ReplaceCmbProxies(bpy.types.Operator):
+    bl_idname = "object.cmb_replace_proxies"
+    bl_label = "Replace CMB Proxies"
+    bl_description = "Load the full models for the selected proxies"
+    bl_options = {'REGISTER', 'UNDO'}
+
+    def execute( self, context ):
+        from .gseb import replaceProxies
+        replaced = replaceProxies(context)
+        self.report({'INFO'} if replaced > 0 else {'WARNING'}, f"Replaced {replaced} proxies")
+        return {'FINISHED'}
+
+# ################################################################
+# Common
+# ################################################################
+
+def menu_func_import( self, context ):
+    self.layout.operator( ImportCmb.bl_idname, text="CtrModelBinary (.cmb)")
+    self.layout.operator( ImportGar.bl_idname, text="GrezzoARchive (.gar)")
+    self.layout.operator( ImportGseb.bl_idname, text="GrezzoSceneBinary (.gseb)")
+    self.layout.operator( ImportCtxb.bl_idname, text="CtrTeXtureBinary (.ctxb)")
+
+def menu_func_object( self, context ):
+    self.layout.operator( ReplaceCmbProxies.bl_idname )
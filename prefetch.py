@@ -0,0 +1,116 @@
+import os, multiprocessing
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from .binary import MemoryReader, openMapped, getContentHash
+from .gar import GAR
+from .ctxb import CTXB, getImageKey, isETC1Format
+from .cmb import readCmb
+from .ctrTexture import DecodeBuffer
+from .session import ImportSession
+from . import profiling
+
+# First phase of a scene import: every model file is read and parsed on a pool of threads and
+# its textures are decoded on a pool of processes, while the main thread steps through the
+# results as they complete. The results go into the session's caches, so the loaders only have
+# to create the Blender datablocks.
+
+# The reads mostly wait on the disk, so there can be more of them than CPUs
+ReadThreads = 16
+
+def decodeTexture(data: bytes, width: int, height: int, format, isETC1: bool) -> np.ndarray:
+    # As float32, which is a quarter of the size of a pickled list of floats to send back
+    return np.array(DecodeBuffer(data, width, height, format, isETC1), dtype=np.float32)
+
+def readModel(f: MemoryReader, models: dict, textures: list):
+    contentHash = getContentHash(f)
+    with profiling.stage("readCmb") as stage:
+        cmb = readCmb(f)
+        stage.count(bytes=cmb.fileSize, items=len(cmb.meshes))
+    models[contentHash] = cmb
+    if cmb.texDataOfs != 0:
+        for t in cmb.textures:
+            start = cmb.texDataOfs + t.dataOffset
+            textures.append((bytes(f.view[start:start + t.dataLength]), t.width, t.height, t.imageFormat, t.isETC1))
+
+def readTextures(f: MemoryReader, folderName: str, fileName: str, textures: list):
+    # Textures that loadCtxb would skip because they're already saved aren't decoded
+    for chunk in CTXB(f).Chunks:
+        for t in chunk.Textures:
+            name = t.Name if t.Name != "" else os.path.splitext(fileName)[0]
+            if not os.path.exists(os.path.join(folderName, f"{name}.png")):
+                textures.append((bytes(t.Data), t.Width, t.Height, t.TextureFormat, isETC1Format(t.TextureFormat)))
+
+def readArchive(gar: GAR, folderName: str, models: dict, textures: list):
+    # Follows loadGar's folder naming, so the saved texture check matches
+    for file in gar:
+        if file.Ext == "ctxb":
+            readTextures(file.open(), folderName, file.FileName, textures)
+        elif file.Ext == "cmb":
+            readModel(file.open(), models, textures)
+        elif file.Ext == "gar":
+            readArchive(GAR(file.open()), os.path.join(folderName, file.FileName.replace("_tex", "")), models, textures)
+
+def readModelFile(modelPath: str, folderName: str) -> tuple[dict, list]:
+    # Returns the parsed models keyed by content hash, and the textures to decode
+    models = {}
+    textures = []
+    if modelPath.endswith(".cmb"):
+        readModel(openMapped(modelPath), models, textures)
+    else:
+        readArchive(GAR(openMapped(modelPath)), folderName, models, textures)
+    return models, textures
+
+def getDecoders(session: ImportSession) -> ProcessPoolExecutor:
+    # Started once per import, as spawning the processes costs more than a small scene's decoding
+    if session.decoders is None:
+        workers = session.prefetchWorkers or os.cpu_count() or 1
+        session.decoders = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+    return session.decoders
+
+def shutdownDecoders(session: ImportSession):
+    if session.decoders is not None:
+        session.decoders.shutdown(cancel_futures=True)
+        session.decoders = None
+
+def iterPrefetch(modelPaths: list[tuple[str, str]], session: ImportSession):
+    # modelPaths are (model path, folder name) pairs, as they'd be passed to the loaders.
+    # Steps once per file read (the first half of the progress) and per texture decoded.
+    decoding = {}
+    decoders = getDecoders(session)
+    readers = ThreadPoolExecutor(max(1, min(ReadThreads, len(modelPaths))))
+    try:
+        reads = {readers.submit(readModelFile, path, folderName): path for path, folderName in modelPaths}
+
+        # Textures start decoding as soon as the file they're in has been read
+        for i, read in enumerate(as_completed(reads)):
+            yield (i + 1) / len(reads) / 2
+            try:
+                models, textures = read.result()
+            except Exception as ex:
+                print(f"Failed to prefetch {reads[read]}")
+                print(ex)
+                continue
+
+            session.models.update(models)
+            if session.proxyMode != 'NONE':
+                continue  # Proxies have no textures
+
+            for data, width, height, format, isETC1 in textures:
+                key = getImageKey(data, width, height, format)
+                if key not in decoding and key not in session.imagesByHash:
+                    decoding[key] = decoders.submit(decodeTexture, data, width, height, format, isETC1)
+
+        keys = {decode: key for key, decode in decoding.items()}
+        for i, decode in enumerate(as_completed(keys)):
+            yield 0.5 + (i + 1) / len(keys) / 2
+            try:
+                session.decodedPixels[keys[decode]] = decode.result()
+            except Exception as ex:
+                print("Failed to decode a texture ahead of time, it will be decoded when it's loaded")
+                print(ex)
+    finally:
+        # When cancelled, the files and textures that haven't been started yet are dropped
+        readers.shutdown(cancel_futures=True)
+        for decode in decoding.values():
+            decode.cancel()
@@ -0,0 +1,132 @@
+import os, time, json, threading
+
+# Wall time, call counts, bytes and items for each stage of an import, per file. Only on when the
+# import asks for it; otherwise stage() and file() hand out a shared do-nothing object, so the
+# instrumented code pays for a function call and an empty with block.
+
+enabled = False
+currentFile = None
+stats = {}  # (file, stage) -> StageStats
+lock = threading.Lock()  # prefetch parses models on worker threads
+
+class StageStats(object):
+    def __init__(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.bytes = 0
+        self.items = 0
+
+    def add(self, other: "StageStats"):
+        self.seconds += other.seconds
+        self.calls += other.calls
+        self.bytes += other.bytes
+        self.items += other.items
+
+    def toDict(self) -> dict:
+        return {"seconds": round(self.seconds, 6), "calls": self.calls, "bytes": self.bytes, "items": self.items}
+
+class StageTimer(object):
+    def __init__(self, name: str, bytes: int, items: int):
+        self.name = name
+        self.bytes = bytes
+        self.items = items
+
+    def count(self, bytes: int = 0, items: int = 0):
+        # For amounts only known once the stage has run
+        self.bytes += bytes
+        self.items += items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        with lock:
+            key = (currentFile, self.name)
+            stage = stats.get(key) or stats.setdefault(key, StageStats())
+            stage.seconds += seconds
+            stage.calls += 1
+            stage.bytes += self.bytes
+            stage.items += self.items
+
+class FileScope(object):
+    # Stages inside are counted against the file, nested files (e.g. a scene's models) take over until they end
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        global currentFile
+        self.previous = currentFile
+        currentFile = self.name
+        return self
+
+    def __exit__(self, *exc):
+        global currentFile
+        currentFile = self.previous
+
+class NullTimer(object):
+    def count(self, bytes: int = 0, items: int = 0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+nullTimer = NullTimer()
+
+def stage(name: str, bytes: int = 0, items: int = 0):
+    return StageTimer(name, bytes, items) if enabled else nullTimer
+
+def file(path: str):
+    return FileScope(os.path.basename(path)) if enabled else nullTimer
+
+def start(enable: bool):
+    global enabled, currentFile
+    enabled = enable
+    currentFile = None
+    stats.clear()
+
+def finish(jsonPath: str = ""):
+    # Prints the summary and writes the JSON file if one was asked for, then turns profiling off again
+    global enabled
+    if not enabled:
+        return
+    enabled = False
+
+    stages, files = summarise()
+    printSummary(stages, files)
+    if jsonPath:
+        try:
+            with open(jsonPath, "w") as f:
+                json.dump({
+                    "stages": {name: s.toDict() for name, s in stages.items()},
+                    "files": {name: {stageName: s.toDict() for stageName, s in fileStages.items()} for name, fileStages in files.items()},
+                }, f, indent=1)
+        except OSError as ex:
+            print(f"Warning: Couldn't write the import profile: {ex}")
+
+def summarise() -> tuple[dict, dict]:
+    # Returns the totals per stage, and per file the totals per stage
+    stages = {}
+    files = {}
+    for (fileName, name), s in stats.items():
+        stages.setdefault(name, StageStats()).add(s)
+        files.setdefault(fileName or "(none)", {})[name] = s
+    return stages, files
+
+def printSummary(stages: dict, files: dict):
+    total = sum(s.seconds for s in stages.values())
+    # prefetch includes the readCmb calls made on its threads, so the stages can add up to more than the import took
+    print("Import profile")
+    print(f"{'Stage':<20}{'Calls':>8}{'Seconds':>10}{'Share':>8}{'MiB':>10}{'Items':>12}")
+    for name, s in sorted(stages.items(), key=lambda item: -item[1].seconds):
+        share = s.seconds / total * 100 if total > 0 else 0
+        print(f"{name:<20}{s.calls:>8}{s.seconds:>10.3f}{share:>7.1f}%{s.bytes / (1 << 20):>10.2f}{s.items:>12}")
+
+    print(f"{'File':<40}{'Seconds':>10}  Slowest stage")
+    for name, fileStages in sorted(files.items(), key=lambda item: -sum(s.seconds for s in item[1].values())):
+        slowest = max(fileStages, key=lambda stageName: fileStages[stageName].seconds)
+        print(f"{name[:39]:<40}{sum(s.seconds for s in fileStages.values()):>10.3f}  {slowest}")
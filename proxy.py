@@ -0,0 +1,80 @@
+import bpy
+import numpy as np
+
+from .cmb import *
+from .binary import getFlag
+from .import_cmb import readAttributeArray
+
+# Stand-in geometry for layout work: a box per shape, or the shape's triangles merged down to
+# a coarse grid. No textures, materials or bones are created for proxies.
+
+DecimateResolution = 16  # Grid cells along the longest side of a shape
+
+BoxFaces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+
+def getShapePositions(f, cmb: Cmb, shape: Sepd, boneTransforms: dict) -> tuple[np.ndarray, np.ndarray]:
+    # Returns the model space positions of the vertices the shape uses, and its triangles indexing them
+    indices = np.array([i for pset in shape.primitiveSets for i in pset.primitive.indices], dtype=np.int64)
+    usedIndices, triangles = np.unique(indices, return_inverse=True)
+    positions = readAttributeArray(f, cmb, cmb.vatr.position, shape.position, usedIndices, 3, 3)
+
+    inc = 1 if cmb.version > 6 else 0
+    hasBi = getFlag(shape.vertFlags, 6, inc)
+    if hasBi:
+        boneIndices = readAttributeArray(f, cmb, cmb.vatr.bIndices, shape.bIndices, usedIndices,
+                                         shape.boneDimensions, 1)[:, 0].astype(np.int64)
+
+    # Smooth skinned vertices are already in the bind pose, the rest are relative to their bone.
+    # A vertex used by several primitive sets takes the last one's binding, as in buildShapeMesh,
+    # so each one is transformed once.
+    boneIds = np.full(len(usedIndices), -1, dtype=np.int64)  # -1 for smooth skinned
+    for pset in shape.primitiveSets:
+        setRows = np.unique(np.searchsorted(usedIndices, pset.primitive.indices))
+        if pset.skinningMode == SkinningMode.Smooth:
+            boneIds[setRows] = -1
+            continue
+        tableIndices = boneIndices[setRows] if hasBi and pset.skinningMode != SkinningMode.Single else np.zeros(len(setRows), np.int64)
+        boneIds[setRows] = np.array(pset.boneTable, dtype=np.int64)[tableIndices]
+
+    for boneId in np.unique(boneIds[boneIds >= 0]).tolist():
+        boneRows = np.flatnonzero(boneIds == boneId)
+        matrix = np.array(boneTransforms[boneId], dtype=np.float32)
+        positions[boneRows] = positions[boneRows] @ matrix[:3, :3] + matrix[3, :3]
+
+    return positions, triangles.reshape(-1, 3)
+
+def decimateTriangles(positions: np.ndarray, triangles: np.ndarray, resolution: int = DecimateResolution) -> tuple[np.ndarray, np.ndarray]:
+    # Vertex clustering: vertices in the same grid cell merge into their average, and
+    # triangles that collapse (or duplicate another) are dropped
+    low = positions.min(axis=0)
+    cellSize = max(float((positions.max(axis=0) - low).max()) / resolution, 1e-6)
+    cells = np.floor((positions - low) / cellSize).astype(np.int64)
+    _, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+
+    counts = np.bincount(cluster)
+    centres = np.zeros((len(counts), 3), dtype=np.float32)
+    np.add.at(centres, cluster, positions)
+    centres /= counts[:, None]
+
+    merged = cluster[triangles]
+    merged = merged[(merged[:, 0] != merged[:, 1]) & (merged[:, 1] != merged[:, 2]) & (merged[:, 0] != merged[:, 2])]
+    _, first = np.unique(np.sort(merged, axis=1), axis=0, return_index=True)
+    return centres, merged[np.sort(first)]
+
+def buildProxyMesh(f, cmb: Cmb, shapeIndex: int, boneTransforms: dict, proxyMode: str):
+    positions, triangles = getShapePositions(f, cmb, cmb.shapes[shapeIndex], boneTransforms)
+    nmesh = bpy.data.meshes.new(f'proxy_{shapeIndex}')
+
+    if proxyMode == 'BOUNDS':
+        # From the decoded positions rather than the Sepd bounds, which older versions don't have
+        # and which aren't in model space for shapes bound to a bone
+        low, high = positions.min(axis=0), positions.max(axis=0)
+        corners = [(x, y, z) for x in (low[0], high[0]) for y in (low[1], high[1]) for z in (low[2], high[2])]
+        nmesh.from_pydata(corners, [], BoxFaces)
+    else:
+        vertices, faces = decimateTriangles(positions, triangles)
+        nmesh.from_pydata(vertices.tolist(), [], faces.tolist())
+
+    nmesh.update()
+    return nmesh
@@ -0,0 +1,49 @@
+class ImportSession(object):
+    # Shared by every loader called from a single import operator, so nested
+    # GAR/GSEB imports see the same options as the top-level file
+    def __init__(self, operator=None):
+        self.analyseUvWraps = getattr(operator, "analyse_uv_wraps", False)
+        self.useCustomNormals = getattr(operator, "use_custom_normals", True)
+        self.bakeCombiners = getattr(operator, "bake_combiners", False)
+        self.deferMaterials = getattr(operator, "defer_materials", False)
+        self.instanceModels = getattr(operator, "instance_models", False)
+        self.prefetchModels = getattr(operator, "prefetch_models", False)
+        self.prefetchWorkers = getattr(operator, "prefetch_workers", 0)  # Threads and processes each, 0 for one per CPU
+        self.proxyMode = getattr(operator, "proxy_mode", 'NONE')
+        self.profile = getattr(operator, "profile_import", False)
+        self.profileJson = getattr(operator, "profile_json", "")
+
+        # Images keyed by a hash of their encoded data, and by the path they're saved to
+        self.imagesByHash = {}
+        self.imagesByPath = {}
+        self.imageKeysByPath = {}  # Hash of the content each path in imagesByPath holds, if it was decoded here
+
+        # Pixels decoded ahead of time by prefetch.iterPrefetch, keyed like imagesByHash
+        self.decodedPixels = {}
+        # The process pool they're decoded on, shared by every GSEB file of the import (see prefetch.getDecoders)
+        self.decoders = None
+
+        # Parsed models keyed by content hash, so a model that appears in many archives is read once
+        self.models = {}
+
+        # Archive entries already imported, keyed by (extension, content hash). For .ctxb entries
+        # the value is the paths of the images they produced, which later copies alias to.
+        self.payloads = {}
+        self.imagePathAliases = {}
+        self.duplicateEntries = 0
+        self.duplicateBytes = 0
+
+        # Mesh datablocks keyed by (model content hash, shape index, is rigid)
+        self.meshes = {}
+
+        # Material datablocks keyed by materials.getMaterialKey
+        self.materials = {}
+
+        # catalog.RomFSCatalog of the RomFS being imported from, if it could be found
+        self.catalog = None
+
+        # Collection each model was loaded into for instancing, keyed by model path (None if it failed)
+        self.instanceSources = {}
+
+        # (armature object, edit bones) waiting to be built in one edit mode pass
+        self.pendingSkeletons = []
@@ -0,0 +1,100 @@
+import numpy as np
+
+# Uniform grid over axis aligned boxes, for region and nearest neighbour queries on scene objects.
+# Each box is listed in every cell it overlaps, apart from very large boxes which are kept
+# separately and always tested, so one huge object can't fill the whole grid.
+
+MaxCellsPerObject = 64
+
+class SpatialGrid(object):
+    def __init__(self, positions: np.ndarray, sizes: np.ndarray):
+        self.positions = np.asarray(positions, dtype=np.float32)
+        half = np.asarray(sizes, dtype=np.float32) / 2
+        self.lows = self.positions - half
+        self.highs = self.positions + half
+        count = len(self.positions)
+
+        if count == 0:
+            self.origin = np.zeros(3, np.float32)
+            self.cellSize = 1.0
+            self.dims = np.ones(3, np.int64)
+        else:
+            # Roughly one object per cell along each axis
+            self.origin = self.lows.min(axis=0)
+            extent = float((self.highs.max(axis=0) - self.origin).max())
+            self.cellSize = max(extent / max(1, round(count ** (1 / 3))), 1e-3)
+            self.dims = np.floor((self.highs.max(axis=0) - self.origin) / self.cellSize).astype(np.int64) + 1
+
+        # Cells as a sorted key array, with the objects of cell keys[i] at ids[starts[i]:starts[i + 1]]
+        firstCells = self.getCell(self.lows)
+        lastCells = self.getCell(self.highs)
+        spans = np.prod(lastCells - firstCells + 1, axis=1)
+        self.large = np.flatnonzero(spans > MaxCellsPerObject)
+
+        keys = []
+        ids = []
+        for i in np.flatnonzero(spans <= MaxCellsPerObject):
+            cells = np.stack(np.meshgrid(*[np.arange(firstCells[i, a], lastCells[i, a] + 1) for a in range(3)], indexing="ij"), axis=-1)
+            keys.append(self.getKey(cells.reshape(-1, 3)))
+            ids.append(np.full(spans[i], i, dtype=np.int64))
+        keys = np.concatenate(keys) if keys else np.zeros(0, np.int64)
+        ids = np.concatenate(ids) if ids else np.zeros(0, np.int64)
+
+        order = np.argsort(keys, kind="stable")
+        self.keys, starts = np.unique(keys[order], return_index=True)
+        self.starts = np.append(starts, len(order))
+        self.ids = ids[order]
+
+    def getCell(self, points: np.ndarray) -> np.ndarray:
+        cells = np.floor((points - self.origin) / self.cellSize).astype(np.int64)
+        return np.clip(cells, 0, self.dims - 1)
+
+    def getKey(self, cells: np.ndarray) -> np.ndarray:
+        return (cells[..., 0] * self.dims[1] + cells[..., 1]) * self.dims[2] + cells[..., 2]
+
+    def getCandidates(self, firstCell: np.ndarray, lastCell: np.ndarray) -> np.ndarray:
+        cells = np.stack(np.meshgrid(*[np.arange(firstCell[a], lastCell[a] + 1) for a in range(3)], indexing="ij"), axis=-1)
+        keys = self.getKey(cells.reshape(-1, 3))
+        slots = np.searchsorted(self.keys, keys)
+        inRange = slots < len(self.keys)
+        slots = slots[inRange]
+        slots = slots[self.keys[slots] == keys[inRange]]
+        if len(slots) == 0:
+            return self.large
+        return np.unique(np.concatenate([self.ids[self.starts[s]:self.starts[s + 1]] for s in slots] + [self.large]))
+
+    def queryRegion(self, low, high) -> np.ndarray:
+        # Indices of the boxes overlapping the region, in ascending order
+        low = np.asarray(low, dtype=np.float32)
+        high = np.asarray(high, dtype=np.float32)
+        if len(self.positions) == 0 or np.any(high < self.origin) or np.any(low > self.origin + self.dims * self.cellSize):
+            return self.large[np.all(self.highs[self.large] >= low, axis=1) & np.all(self.lows[self.large] <= high, axis=1)]
+
+        candidates = self.getCandidates(self.getCell(low), self.getCell(high))
+        overlaps = np.all(self.highs[candidates] >= low, axis=1) & np.all(self.lows[candidates] <= high, axis=1)
+        return candidates[overlaps]
+
+    def queryNearest(self, point, count: int = 1) -> np.ndarray:
+        # Indices of the count objects whose positions are nearest the point, nearest first
+        point = np.asarray(point, dtype=np.float32)
+        count = min(count, len(self.positions))
+        if count == 0:
+            return np.zeros(0, np.int64)
+
+        centre = self.getCell(point)
+        radius = 0
+        while True:
+            firstCell = np.maximum(centre - radius, 0)
+            lastCell = np.minimum(centre + radius, self.dims - 1)
+            candidates = self.getCandidates(firstCell, lastCell)
+            coversGrid = np.all(firstCell == 0) and np.all(lastCell == self.dims - 1)
+            if coversGrid:
+                candidates = np.arange(len(self.positions))
+
+            if len(candidates) >= count:
+                distances = np.linalg.norm(self.positions[candidates] - point, axis=1)
+                nearest = np.argsort(distances, kind="stable")[:count]
+                # Anything closer than the furthest match must be inside the cells searched so far
+                if coversGrid or distances[nearest[-1]] <= radius * self.cellSize:
+                    return candidates[nearest]
+            radius += 1
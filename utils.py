@@ -1,11 +1,11 @@
-import struct, math, mathutils, bpy
+import math, mathutils, bpy
 
-from io import BufferedReader
 from mathutils import Vector
-from .cmbEnums import DataTypes
+from .binary import *
 
 def get_or_add_root():
-    for area in bpy.context.screen.areas:
+    # No screen when Blender runs in the background (batch.py)
+    for area in bpy.context.screen.areas if bpy.context.screen is not None else []:
         if area.type == 'VIEW_3D':
             for space in area.spaces:
                 if space.type == 'VIEW_3D':
@@ -27,80 +27,27 @@ def get_or_add_root():
 
     return root
 
-
-def getFlag(value, index, increment):
-    index += increment
-    return ((value >> index) & 1) != 0
-
-def align(file: BufferedReader, size=4):
-    while (file.tell() % size):
-        file.seek(file.tell() + 1)
-
-def readUByte(file: BufferedReader) -> int:
-    return struct.unpack("B", file.read(1))[0]
-
-def readByte(file: BufferedReader) -> int:
-    return struct.unpack("b", file.read(1))[0]
-
-def readBytes(file: BufferedReader, count) -> list[int]:
-    return [readUByte(file) for _ in range(count)]
-
-def readUShort(file: BufferedReader) -> int:
-    return struct.unpack("<H", file.read(2))[0]
-
-def readShort(file: BufferedReader) -> int:
-    return struct.unpack("<h", file.read(2))[0]
-
-def readUInt32(file: BufferedReader) -> int:
-    return struct.unpack("<I", file.read(4))[0]
-
-def readInt32(file: BufferedReader) -> int:
-    return struct.unpack("<i", file.read(4))[0]
-
-def readFloat(file: BufferedReader) -> float:
-    return struct.unpack("<f", file.read(4))[0]
-
-def readArray(file: BufferedReader, elements, datatype: DataTypes = DataTypes.Float) -> list:
-    return [readDataType(file, datatype) for _ in range(elements)]
-
-def readDataType(file: BufferedReader, dt: DataTypes):
-    match dt:
-        case DataTypes.Byte:
-            return readByte(file)
-        case DataTypes.UByte:
-            return readUByte(file)
-        case DataTypes.Short:
-            return readShort(file)
-        case DataTypes.UShort:
-            return readUShort(file)
-        case DataTypes.Int:
-            return readInt32(file)
-        case DataTypes.UInt:
-            return readUInt32(file)
-        case _:
-            return readFloat(file)
-
-def getDataTypeSize(dt) -> int:
-    match dt:
-        case DataTypes.Byte | DataTypes.UByte:
-            return 1
-        case DataTypes.Short | DataTypes.UShort:
-            return 2
-        case _:
-            return 4
-
-def readString(file: BufferedReader, length=0) -> str:
-    if (length > 0):
-        return file.read(length).decode("ASCII").replace("\x00", '')
-    else:
-        return ''.join(iter(lambda: file.read(1).decode("ASCII"), '\x00' or ''))
-
-def readOffsetString(file: BufferedReader, offset: int, length: int = 0) -> str:
-    temp = file.tell()
-    file.seek(offset)
-    value = readString(file, length)
-    file.seek(temp)
-    return value
+# Loaders are generators that yield their progress (0 to 1) after each chunk of work, so the
+# import operators can run them a few steps at a time and stop them early (see operators.ModalImport)
+def runSteps(steps):
+    # Runs the steps to the end and returns the loader's result
+    while True:
+        try:
+            next(steps)
+        except StopIteration as stop:
+            return stop.value
+
+def scaleSteps(steps, index: int, count: int):
+    # Yields the progress of item index of count as progress over all of them, and returns its result
+    try:
+        while True:
+            try:
+                progress = next(steps)
+            except StopIteration as stop:
+                return stop.value
+            yield (index + (progress or 0)) / count
+    finally:
+        steps.close()
 
 # Ported from OpenTK
 # blender might have something but I'm too lazy to check